@@ -1,59 +1,384 @@
+import argparse
+import bisect
+import hashlib
+import itertools
+import mmap
+import os
+import pickle
+import struct
 import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import instrument  # noqa: E402
+
+trace = instrument.Tracer("assembler")
+
+# Bit-fields of a C-instruction word: 111a cccc ccdd djjj
+COMP = {
+    "0": 0b0101010,
+    "1": 0b0111111,
+    "-1": 0b0111010,
+    "D": 0b0001100,
+    "A": 0b0110000,
+    "!D": 0b0001101,
+    "!A": 0b0110001,
+    "-D": 0b0001111,
+    "-A": 0b0110011,
+    "D+1": 0b0011111,
+    "A+1": 0b0110111,
+    "D-1": 0b0001110,
+    "A-1": 0b0110010,
+    "D+A": 0b0000010,
+    "D-A": 0b0010011,
+    "A-D": 0b0000111,
+    "D&A": 0b0000000,
+    "D|A": 0b0010101,
+}
+for c in ["D+1", "A+1", "D+A", "D&A", "D|A"]:
+    COMP[c[2] + c[1] + c[0]] = COMP[c]
+for c in [c for c in COMP if "A" in c]:
+    COMP[c.replace("A", "M")] = COMP[c] | 0b1000000
+
+DEST = {None: 0, "": 0}
+for n in range(1, 4):
+    for regs in itertools.permutations("ADM", n):
+        DEST["".join(regs)] = ((("A" in regs) << 2) | (("D" in regs) << 1) |
+                               ("M" in regs))
+
+JUMP = {None: 0, "": 0}
+for bits, j in enumerate(["JGT", "JEQ", "JGE", "JLT", "JNE", "JLE", "JMP"]):
+    JUMP[j] = bits + 1
+
+# Packed .hackb file: magic, version, reserved, word count, then the words
+# as little-endian uint16.
+BINARY_MAGIC = b"HACK"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sHHI")
+
+CACHE_VERSION = 1
+
+# A-instructions hold 15-bit values; a set high bit would make a C-instruction.
+MAX_ADDRESS = 0x7FFF
+
+# Source map markers written by the VM translator: "//@ file:line function
+# command" before the instructions translated from that command.
+SOURCE_MARKER = "//@"
+
+
+class AddressError(ValueError):
+    # A label, variable or literal past what an A-instruction holds, e.g.
+    # a label in a program too big for ROM.
+    pass
 
 
 class Assembler:
-    def __init__(self, filename):
+    def __init__(self, filename, streaming=False, binary=False):
         self.filename = filename
+        self.streaming = streaming
+        self.binary = binary
         self.symbols = SymbolTable()
-        self.parser = Parser(filename, self.symbols)
+        if (streaming):
+            self.parser = StreamingParser(filename, self.symbols)
+        else:
+            self.parser = Parser(filename, self.symbols)
         self.code = Code()
-        self.output = ""
+        self.words = list()
         self.count = 0
 
     def assemble(self):
+        try:
+            with trace.phase("label"):
+                self.labelPass()
+
+            self.traceSymbols()
+
+            self.parser.reset()
+
+            if (self.streaming):
+                self.writeWords(self.encodePass())
+            else:
+                with trace.phase("encode"):
+                    self.words.extend(self.encodePass())
+                self.writeWords(self.words)
+        finally:
+            self.parser.close()
+
+    def program(self):
+        # Assembles into self.words without writing a .hack file.
+        try:
+            self.labelPass()
+            self.parser.reset()
+            self.words.extend(self.encodePass())
+            return self.words
+        finally:
+            self.parser.close()
+
+    def labelPass(self):
         while (self.parser.hasMoreCommands()):
             self.parser.advance()
             if (self.parser.commandType() == "A_COMMAND" or
                     self.parser.commandType() == "C_COMMAND"):
                 self.count += 1
             elif (self.parser.commandType() == "L_COMMAND"):
-                self.symbols.addEntry(self.parser.rawSymbol(), self.count)
-
-        print(self.symbols.symbols)
-
-        self.parser.reset()
+                self.symbols.addLabel(self.parser.rawSymbol(), self.count)
 
+    def encodePass(self):
         while (self.parser.hasMoreCommands()):
             self.parser.advance()
             if (self.parser.commandType() == "A_COMMAND"):
                 self.count += 1
-                self.output += "0"
-                binary = "{0:015b}".format(self.parser.symbol())
-                self.output += binary
-                self.output += "\n"
+                yield self.parser.symbol()
             elif (self.parser.commandType() == "L_COMMAND"):
                 pass
             else:
                 self.count += 1
-                self.output += "111"
-                comp = self.parser.comp()
-                dest = self.parser.dest()
-                jump = self.parser.jump()
-                self.output += self.code.comp(comp)
-                self.output += self.code.dest(dest)
-                self.output += self.code.jump(jump)
-                self.output += "\n"
-        out = open(self.filename[0:self.filename.find(".")] + ".hack", "w")
-        out.write(self.output)
+                yield self.cInstruction()
+
+    def assembleSinglePass(self):
+        # Forward references are left as holes in words and patched once
+        # every label has been seen. Unresolved symbols are recorded in
+        # first-reference order so variables get the same addresses as in
+        # the two-pass assembler.
+        try:
+            words = self.words
+            pending = dict()
+            with trace.phase("parse"):
+                self.parseSinglePass(words, pending)
+
+            with trace.phase("patch"):
+                for sym, holes in pending.items():
+                    address = self.symbols.lookup(sym)
+                    if (address is None):
+                        address = self.symbols.addVariable(sym)
+                    if (address > MAX_ADDRESS):
+                        raise rangeError(self.filename, sym, address)
+                    for index in holes:
+                        words[index] = address
+
+            self.traceSymbols()
+
+            self.writeWords(self.words)
+        finally:
+            self.parser.close()
+
+    def parseSinglePass(self, words, pending):
+        while (self.parser.hasMoreCommands()):
+            self.parser.advance()
+            if (self.parser.commandType() == "L_COMMAND"):
+                self.symbols.addLabel(self.parser.rawSymbol(), self.count)
+            elif (self.parser.commandType() == "A_COMMAND"):
+                self.count += 1
+                sym = self.parser.rawSymbol()
+                if (sym.isdigit() or self.symbols.contains(sym)):
+                    words.append(self.parser.symbol())
+                else:
+                    pending.setdefault(sym, list()).append(len(words))
+                    words.append(None)
+            else:
+                self.count += 1
+                words.append(self.cInstruction())
+
+    def assembleParallel(self, jobs=None):
+        try:
+            with trace.phase("prepass"):
+                lines = self.prepass()
+
+            self.traceSymbols()
+
+            jobs = jobs or os.cpu_count()
+            size = max(1, -(-len(lines) // (jobs * 4)))
+            shards = [lines[i:i + size] for i in range(0, len(lines), size)]
+            trace.count("shards", len(shards))
+            with trace.phase("encode"):
+                with ProcessPoolExecutor(jobs, initializer=initShard,
+                                         initargs=(self.filename,
+                                                   self.symbols)) as pool:
+                    for words in pool.map(encodeShard, shards):
+                        self.words.extend(words)
+            self.writeWords(self.words)
+        finally:
+            self.parser.close()
+
+    def prepass(self):
+        # Resolves labels and allocates variables without decoding C
+        # instructions, so shards can be encoded independently afterwards.
+        # Variables are allocated in first-reference order, as in assemble.
+        lines = list()
+        referenced = dict()
+        while (self.parser.hasMoreCommands()):
+            l = self.parser.currentLine().strip()
+            l = self.parser.stripComments(l).strip()
+            if (l.startswith("(")):
+                self.symbols.addLabel(l[1:l.find(")")], len(lines))
+                continue
+            if (l.startswith("@")):
+                sym = l[1:]
+                if (not sym.isdigit() and not self.symbols.contains(sym)):
+                    referenced[sym] = None
+            lines.append(l)
+
+        for sym in referenced:
+            if (not self.symbols.contains(sym)):
+                self.symbols.addVariable(sym)
+        self.count = len(lines)
+        return lines
+
+    def assembleIncremental(self, cacheFile=None):
+        # The source is split into blocks at labels and each block's
+        # encoding is cached under the hash of its instructions. Symbolic
+        # A-instructions are kept as names in the cached template, so a hit
+        # only needs re-patching when the resolved symbol table changed.
+        try:
+            if (cacheFile is None):
+                cacheFile = self.outputName(".asmcache")
+            cache = loadCache(cacheFile)
+            with trace.phase("blocks"):
+                blocks = self.encodeBlocks(cache)
+
+            self.traceSymbols()
+
+            resolved = self.symbols.symbols
+            reuse = (cache["symbols"] == resolved)
+            saved = dict()
+            with trace.phase("patch"):
+                for key, entry in blocks:
+                    if (not reuse or "words" not in entry):
+                        for sym in entry["refs"]:
+                            if (resolved[sym] > MAX_ADDRESS):
+                                raise rangeError(self.filename, sym,
+                                                 resolved[sym])
+                        entry["words"] = array("H", [
+                            resolved[w] if isinstance(w, str) else w
+                            for w in entry["template"]])
+                    self.words.extend(entry["words"])
+                    saved[key] = entry
+            self.writeWords(self.words)
+            saveCache(cacheFile, {"version": CACHE_VERSION, "blocks": saved,
+                                  "symbols": dict(resolved)})
+        finally:
+            self.parser.close()
+
+    def encodeBlocks(self, cache):
+        blocks = list()
+        referenced = dict()
+        for label, lines in self.readBlocks():
+            key = hashlib.sha1("\n".join(lines).encode()).hexdigest()
+            entry = cache["blocks"].get(key)
+            if (entry is None):
+                trace.count("block misses")
+                entry = self.encodeBlock(lines)
+            else:
+                trace.count("block hits")
+            if (label is not None):
+                self.symbols.addLabel(label, self.count)
+            for sym in entry["refs"]:
+                if (not self.symbols.contains(sym)):
+                    referenced.setdefault(sym, None)
+            self.count += len(entry["template"])
+            blocks.append((key, entry))
+
+        for sym in referenced:
+            if (not self.symbols.contains(sym)):
+                self.symbols.addVariable(sym)
+        return blocks
+
+    def readBlocks(self):
+        label = None
+        lines = list()
+        while (self.parser.hasMoreCommands()):
+            l = self.parser.currentLine().strip()
+            l = self.parser.stripComments(l).strip()
+            if (l.startswith("(")):
+                yield label, lines
+                label = l[1:l.find(")")]
+                lines = list()
+            else:
+                lines.append(l)
+        yield label, lines
+
+    def encodeBlock(self, lines):
+        parser = Parser(None, self.symbols, lines)
+        template = list()
+        refs = dict()
+        while (parser.hasMoreCommands()):
+            parser.advance()
+            if (parser.commandType() == "A_COMMAND"):
+                sym = parser.rawSymbol()
+                if (sym.isdigit()):
+                    if (int(sym) > MAX_ADDRESS):
+                        raise rangeError(self.filename, sym, int(sym))
+                    template.append(int(sym))
+                else:
+                    template.append(sym)
+                    refs.setdefault(sym, None)
+            else:
+                template.append(self.cInstruction(parser))
+        return {"template": template, "refs": list(refs)}
+
+    def cInstruction(self, parser=None):
+        parser = parser or self.parser
+        try:
+            return self.code.encode(parser.comp(), parser.dest(),
+                                    parser.jump())
+        except ValueError as e:
+            raise mnemonicError(self.filename, parser.instruction(),
+                                e) from None
+
+    def outputName(self, suffix):
+        # The source's path with its extension replaced, e.g. Prog.asm ->
+        # Prog.hack, where the profiler and emulator look for it.
+        return os.path.splitext(self.filename)[0] + suffix
+
+    def writeWords(self, words):
+        if (self.binary):
+            writer = BinaryHackWriter(self.outputName(".hackb"))
+        else:
+            writer = HackWriter(self.outputName(".hack"))
+        with trace.phase("write"):
+            try:
+                for word in words:
+                    writer.write(word)
+            finally:
+                writer.close()
+        self.countSymbols(writer.count)
+
+    def writeSourceMap(self):
+        with open(self.filename, "r") as file:
+            entries = readSourceMap(file)
+        with open(self.outputName(".map"), "w") as out:
+            for entry in entries:
+                out.write("\t".join(str(field) for field in entry) + "\n")
+        trace.count("source map entries", len(entries))
+
+    def countSymbols(self, instructions):
+        trace.count("lines", self.parser.lineCount())
+        trace.count("instructions", instructions)
+        trace.count("symbols", len(self.symbols))
+        trace.count("variables", self.symbols.variableCount())
+        trace.count("labels", self.symbols.labelCount())
+
+    def traceSymbols(self):
+        if (trace.debugging):
+            trace.debug("symbols: {}", self.symbols.symbols)
 
 
 class Parser:
-    def __init__(self, filename, symbols):
-        file = open(filename, "r")
-        self.lines = file.readlines()
+    def __init__(self, filename, symbols, lines=None):
+        if (lines is None):
+            file = open(filename, "r")
+            lines = file.readlines()
+            file.close()
+        self.filename = filename
+        self.lines = lines
         self.symbols = symbols
         self.reset()
 
+    def lineCount(self):
+        return len(self.lines)
+
     def reset(self):
         self.current_index = -1
 
@@ -69,9 +394,19 @@ class Parser:
         return True
 
     def advance(self):
-        l = self.lines[self.current_index].strip()
-        l = self.stripComments(l)
-        print(l)
+        self.parse(self.currentLine())
+
+    def currentLine(self):
+        return self.lines[self.current_index]
+
+    def instruction(self):
+        # The current instruction as written, without comments.
+        return self.stripComments(self.currentLine().strip()).strip()
+
+    def parse(self, l):
+        l = self.stripComments(l.strip()).strip()
+        if (trace.debugging):
+            trace.debug(l)
         if (l.startswith("(")):
             self.command = "L_COMMAND"
             self.sym = l[1:l.find(")")]
@@ -98,12 +433,14 @@ class Parser:
 
     def symbol(self):
         if (self.sym.isdigit()):
-            return int(self.sym)
-
-        if (not self.symbols.contains(self.sym)):
-            self.symbols.addEntry(self.sym, self.symbols.getNextAddress())
-
-        return self.symbols.getAddress(self.sym)
+            address = int(self.sym)
+        else:
+            address = self.symbols.lookup(self.sym)
+            if (address is None):
+                address = self.symbols.addVariable(self.sym)
+        if (address > MAX_ADDRESS):
+            raise rangeError(self.filename, self.sym, address)
+        return address
 
     def dest(self):
         return self.destination
@@ -120,92 +457,297 @@ class Parser:
             l = l[:comment_start]
         return l
 
+    def close(self):
+        # Lines are read whole up front, so there is nothing to close.
+        pass
+
+
+class StreamingParser(Parser):
+    def __init__(self, filename, symbols):
+        self.filename = filename
+        self.symbols = symbols
+        self.file = None
+        self.reset()
+
+    def reset(self):
+        if (self.file is not None):
+            self.file.close()
+        self.file = open(self.filename, "r")
+        self.line = None
+        self.lines_read = 0
+
+    def lineCount(self):
+        return self.lines_read
+
+    def hasMoreCommands(self):
+        for line in self.file:
+            self.lines_read += 1
+            line = line.strip()
+            if (line != "" and not line.startswith("//")):
+                self.line = line
+                return True
+        return False
+
+    def currentLine(self):
+        return self.line
+
+    def close(self):
+        self.file.close()
+
+
+class HackWriter:
+    def __init__(self, filename, chunk=65536):
+        self.output = open(filename, "w")
+        self.chunk = chunk
+        self.buffer = list()
+        self.count = 0
+
+    def write(self, word):
+        self.buffer.append(word)
+        if (len(self.buffer) >= self.chunk):
+            self.flush()
+
+    def flush(self):
+        self.output.write("".join(["{0:016b}\n".format(w)
+                                   for w in self.buffer]))
+        self.count += len(self.buffer)
+        self.buffer = list()
+
+    def close(self):
+        self.flush()
+        self.output.close()
+
+
+class BinaryHackWriter(HackWriter):
+    def __init__(self, filename, chunk=65536):
+        self.output = open(filename, "wb")
+        self.chunk = chunk
+        self.buffer = list()
+        self.count = 0
+        self.writeHeader()
+
+    def writeHeader(self):
+        self.output.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0,
+                                             self.count))
+
+    def flush(self):
+        words = array("H", self.buffer)
+        if (sys.byteorder != "little"):
+            words.byteswap()
+        self.output.write(words.tobytes())
+        self.count += len(self.buffer)
+        self.buffer = list()
+
+    def close(self):
+        self.flush()
+        self.output.seek(0)
+        self.writeHeader()
+        self.output.close()
+
+
+def loadCache(filename):
+    try:
+        with open(filename, "rb") as file:
+            cache = pickle.load(file)
+        if (cache.get("version") == CACHE_VERSION):
+            return cache
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+    return {"version": CACHE_VERSION, "blocks": dict(), "symbols": None}
+
+
+def saveCache(filename, cache):
+    with open(filename, "wb") as file:
+        pickle.dump(cache, file, pickle.HIGHEST_PROTOCOL)
+
+
+def findLine(filename, command):
+    # The line of the first instruction reading command. Only looked up
+    # when reporting an error, so the passes need not keep line numbers.
+    with open(filename, "r") as file:
+        for number, l in enumerate(file, 1):
+            l = l.strip()
+            comment_start = l.find("//")
+            if (comment_start != -1):
+                l = l[:comment_start]
+            if (l.strip() == command):
+                return number
+    return "?"
+
+
+def rangeError(filename, symbol, address):
+    return AddressError("{}:{}: @{} is {}, more than an A-instruction "
+                        "holds ({})".format(filename,
+                                            findLine(filename, "@" + symbol),
+                                            symbol, address, MAX_ADDRESS))
+
+
+def mnemonicError(filename, command, error):
+    return ValueError("{}:{}: {} in {}".format(
+        filename, findLine(filename, command), error, command))
+
+
+_shard = dict()
+
+
+def initShard(filename, symbols):
+    _shard["parser"] = Parser(filename, symbols, list())
+    _shard["code"] = Code()
+
+
+def encodeShard(lines):
+    parser = _shard["parser"]
+    code = _shard["code"]
+    parser.lines = lines
+    parser.reset()
+    words = array("H")
+    while (parser.hasMoreCommands()):
+        parser.advance()
+        if (parser.commandType() == "A_COMMAND"):
+            words.append(parser.symbol())
+        else:
+            try:
+                words.append(code.encode(parser.comp(), parser.dest(),
+                                         parser.jump()))
+            except ValueError as e:
+                raise mnemonicError(parser.filename, parser.instruction(),
+                                    e) from None
+    return words
+
+
+def readSourceMap(lines):
+    # Returns (start, end, file, line, function, command) for every marker
+    # that is followed by at least one instruction, where start and end
+    # are the ROM addresses of its first and one past its last instruction.
+    entries = list()
+    current = None
+    address = 0
+    for l in lines:
+        l = l.strip()
+        if (l.startswith(SOURCE_MARKER)):
+            if (current is not None and address > current[0]):
+                entries.append((current[0], address) + current[1:])
+            location, function, command = l[len(SOURCE_MARKER):].split(
+                None, 2)
+            source, line = location.rsplit(":", 1)
+            current = (address, source, int(line), function, command)
+        elif (l != "" and not l.startswith("//") and not l.startswith("(")):
+            address += 1
+    if (current is not None and address > current[0]):
+        entries.append((current[0], address) + current[1:])
+    return entries
+
+
+def loadSourceMap(filename):
+    entries = list()
+    with open(filename, "r") as file:
+        for l in file:
+            start, end, source, line, function, command = \
+                l.rstrip("\n").split("\t")
+            entries.append((int(start), int(end), source, int(line),
+                            function, command))
+    return entries
+
+
+def loadBinary(filename):
+    # Returns the ROM words as a read-only uint16 view over an mmap of the
+    # file; no words are copied on little-endian hosts.
+    with open(filename, "rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, _, count = BINARY_HEADER.unpack_from(data)
+    if (magic != BINARY_MAGIC or version != BINARY_VERSION):
+        raise ValueError("not a packed hack file: " + filename)
+    start = BINARY_HEADER.size
+    words = memoryview(data)[start:start + 2 * count].cast("H")
+    if (sys.byteorder != "little"):
+        words = array("H", words)
+        words.byteswap()
+    return words
+
+
+def loadHack(filename):
+    with open(filename, "rb") as file:
+        magic = file.read(len(BINARY_MAGIC))
+    if (magic == BINARY_MAGIC):
+        return loadBinary(filename)
+    with open(filename, "r") as file:
+        return array("H", [int(l, 2) for l in file if l.strip() != ""])
+
+
+def field(table, kind, mnemonic):
+    # The bits of a comp, dest or jump mnemonic, ignoring spaces around it.
+    if (mnemonic is not None):
+        mnemonic = mnemonic.strip()
+    bits = table.get(mnemonic)
+    if (bits is None):
+        raise ValueError("unknown {} {!r}".format(kind, mnemonic))
+    return bits
+
 
 class Code:
+    def encode(self, comp, dest, jump):
+        try:
+            return 0xE000 | COMP[comp] << 6 | DEST[dest] << 3 | JUMP[jump]
+        except KeyError:
+            pass
+        # Only spaced or unknown mnemonics miss the tables.
+        return (0xE000 | field(COMP, "comp", comp) << 6 |
+                field(DEST, "dest", dest) << 3 | field(JUMP, "jump", jump))
+
     def dest(self, input):
-        output = ""
-        output += "1" if "A" in input else "0"
-        output += "1" if "D" in input else "0"
-        output += "1" if "M" in input else "0"
-        return output
+        return "{0:03b}".format(field(DEST, "dest", input))
 
     def comp(self, input):
-        a = "1" if "M" in input else "0"
-        c = input.replace("M", "A").strip()
-        if (c == "0"):
-            return a + "101010"
-        if (c == "1"):
-            return a + "111111"
-        if (c == "-1"):
-            return a + "111010"
-        if (c == "D"):
-            return a + "001100"
-        if (c == "A"):
-            return a + "110000"
-        if (c == "!D"):
-            return a + "001101"
-        if (c == "!A"):
-            return a + "110001"
-        if (c == "-D"):
-            return a + "001111"
-        if (c == "-A"):
-            return a + "110011"
-        if (c == "D+1"):
-            return a + "011111"
-        if (c == "A+1"):
-            return a + "110111"
-        if (c == "D-1"):
-            return a + "001110"
-        if (c == "A-1"):
-            return a + "110010"
-        if (c == "D+A"):
-            return a + "000010"
-        if (c == "D-A"):
-            return a + "010011"
-        if (c == "A-D"):
-            return a + "000111"
-        if (c == "D&A"):
-            return a + "000000"
-        if (c == "D|A"):
-            return a + "010101"
-        print("error: " + c)
+        return "{0:07b}".format(field(COMP, "comp", input))
 
     def jump(self, input):
-        if (input is None):
-            return "000"
-        input = input.strip()
-        if (input == "JGT"):
-            return "001"
-        if (input == "JEQ"):
-            return "010"
-        if (input == "JGE"):
-            return "011"
-        if (input == "JLT"):
-            return "100"
-        if (input == "JNE"):
-            return "101"
-        if (input == "JLE"):
-            return "110"
-        if (input == "JMP"):
-            return "111"
+        return "{0:03b}".format(field(JUMP, "jump", input))
+
+
+PREDEFINED = [("R" + str(x), x) for x in range(0, 16)] + [
+    ("SP", 0),
+    ("LCL", 1),
+    ("ARG", 2),
+    ("THIS", 3),
+    ("THAT", 4),
+    ("SCREEN", 16384),
+    ("KBD", 24576),
+]
+PREDEFINED_SYMBOLS = {sys.intern(name): address
+                      for name, address in PREDEFINED}
+VARIABLE_BASE = 16
 
 
 class SymbolTable:
+    # Lookups go through one dict of interned names. Labels (ROM) and
+    # variables (RAM) are also kept in address order so an address can be
+    # mapped back to its symbol.
     def __init__(self):
-        self.symbols = dict()
-        self.nextAddress = 16
-        for x in range(0, 16):
-            self.addEntry("R" + str(x), x)
-        self.addEntry("SP", 0)
-        self.addEntry("LCL", 1)
-        self.addEntry("ARG", 2)
-        self.addEntry("THIS", 3)
-        self.addEntry("THAT", 4)
-        self.addEntry("SCREEN", 16384)
-        self.addEntry("KBD", 24576)
+        self.symbols = dict(PREDEFINED_SYMBOLS)
+        # The parser calls this for every symbolic A-instruction, so it is
+        # the dict's own get rather than a method wrapping it.
+        self.lookup = self.symbols.get
+        self.label_names = list()
+        self.label_addresses = array("i")
+        self.variable_names = list()
+        self.nextAddress = VARIABLE_BASE
+
+    def __len__(self):
+        return len(self.symbols)
 
     def addEntry(self, symbol, address):
+        symbol = sys.intern(symbol)
         self.symbols[symbol] = address
+        return symbol
+
+    def addLabel(self, symbol, address):
+        self.label_names.append(self.addEntry(symbol, address))
+        self.label_addresses.append(address)
+
+    def addVariable(self, symbol):
+        address = self.getNextAddress()
+        self.variable_names.append(self.addEntry(symbol, address))
+        return address
 
     def contains(self, symbol):
         return symbol in self.symbols
@@ -218,7 +760,58 @@ class SymbolTable:
         self.nextAddress += 1
         return last
 
+    def labelCount(self):
+        return len(self.label_names)
+
+    def variableCount(self):
+        return len(self.variable_names)
+
+    def labelAt(self, address):
+        # Name of the last label at or before a ROM address, or None.
+        i = bisect.bisect_right(self.label_addresses, address)
+        if (i == 0):
+            return None
+        return self.label_names[i - 1]
+
+    def variableAt(self, address):
+        # Name of the RAM symbol at an address, preferring variables over
+        # predefined names.
+        i = address - VARIABLE_BASE
+        if (0 <= i < len(self.variable_names)):
+            return self.variable_names[i]
+        for name, predefined in PREDEFINED:
+            if (predefined == address):
+                return name
+        return None
 
 if (__name__ == "__main__"):
-    assembler = Assembler(sys.argv[1])
-    assembler.assemble()
+    args = argparse.ArgumentParser()
+    args.add_argument("filename")
+    args.add_argument("--single-pass", action="store_true",
+                      help="resolve labels by backpatching in one pass")
+    args.add_argument("--stream", action="store_true",
+                      help="read and write in chunks instead of in memory")
+    args.add_argument("--binary", action="store_true",
+                      help="write packed little-endian words to .hackb")
+    args.add_argument("--jobs", type=int, default=None,
+                      help="encode shards on this many processes")
+    args.add_argument("--cache", nargs="?", const="", default=None,
+                      help="reuse block encodings from a cache file")
+    args.add_argument("--source-map", action="store_true",
+                      help="write ROM ranges of the VM translator's source "
+                           "markers to a .map file")
+    instrument.addArguments(args)
+    args = args.parse_args()
+    instrument.configure(trace, args)
+    assembler = Assembler(args.filename, args.stream, args.binary)
+    if (args.cache is not None):
+        assembler.assembleIncremental(args.cache or None)
+    elif (args.jobs is not None):
+        assembler.assembleParallel(args.jobs)
+    elif (args.single_pass):
+        assembler.assembleSinglePass()
+    else:
+        assembler.assemble()
+    if (args.source_map):
+        assembler.writeSourceMap()
+    instrument.finish(trace, args)
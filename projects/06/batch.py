@@ -0,0 +1,166 @@
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from emulator import (A_OP, CM_OP, JUMPS, RAM_SIZE, Snapshot, decode,
+                      loadProgram, parseRange, romChecksum, trace)
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import instrument  # noqa: E402
+
+# Jump tables as arrays so a whole group's outputs can index them at once.
+JUMP_ARRAYS = [None if j is None else np.frombuffer(j, dtype=np.uint8) != 0
+               for j in JUMPS]
+
+
+class BatchEmulator:
+    # Runs count copies of one ROM in lockstep. Registers are int64 arrays
+    # holding unsigned 16-bit values and RAM is a (count, RAM_SIZE) uint16
+    # array. Each step executes one instruction per distinct PC, on every
+    # machine currently at that PC.
+    def __init__(self, rom, count):
+        self.rom = list(rom)
+        self.ops = [self.decode(word) for word in self.rom]
+        self.count = count
+        self.rows = np.arange(count)
+        self.ram = np.zeros((count, RAM_SIZE), dtype=np.uint16)
+        self.reset()
+
+    def decode(self, word):
+        kind, arg, dest, jump = decode(word)
+        if (jump is not None):
+            jump = JUMP_ARRAYS[word & 0b111]
+        return (kind, arg, dest, jump)
+
+    def reset(self):
+        self.a = np.zeros(self.count, dtype=np.int64)
+        self.d = np.zeros(self.count, dtype=np.int64)
+        self.pc = np.zeros(self.count, dtype=np.int64)
+        self.cycles = np.zeros(self.count, dtype=np.int64)
+        self.steps = 0
+
+    def restore(self, snapshot):
+        # Forks every machine from one emulator Snapshot.
+        if (self.rom and romChecksum(self.rom) != snapshot.checksum):
+            raise ValueError("snapshot was taken with a different ROM")
+        self.ram[:] = np.frombuffer(snapshot.buffer, dtype="<u2")
+        self.a[:] = snapshot.a
+        self.d[:] = snapshot.d
+        self.pc[:] = snapshot.pc
+        self.cycles[:] = snapshot.cycles
+
+    def peek(self, address):
+        return self.ram[:, address].astype(np.int16)
+
+    def poke(self, address, values):
+        self.ram[:, address] = np.asarray(values, dtype=np.int64) & 0xFFFF
+
+    def halted(self):
+        return self.pc >= len(self.ops)
+
+    def groups(self):
+        pc = self.pc
+        first = pc[0]
+        if (first < len(self.ops) and (pc == first).all()):
+            return [(int(first), slice(None))]
+        active = np.flatnonzero(pc < len(self.ops))
+        if (len(active) == 0):
+            return list()
+        order = active[np.argsort(pc[active], kind="stable")]
+        ordered = pc[order]
+        starts = np.flatnonzero(np.diff(ordered)) + 1
+        return [(int(pc[group[0]]), group)
+                for group in np.split(order, starts)]
+
+    def run(self, steps):
+        done = 0
+        while (done < steps):
+            groups = self.groups()
+            if (not groups):
+                break
+            trace.count("groups", len(groups))
+            for pc, machines in groups:
+                self.execute(pc, machines)
+            done += 1
+        self.steps += done
+        return done
+
+    def execute(self, pc, machines):
+        kind, arg, dest, jump = self.ops[pc]
+        self.cycles[machines] += 1
+        if (kind == A_OP):
+            self.a[machines] = arg
+            self.pc[machines] = pc + 1
+            return
+        a = self.a[machines].copy()
+        d = self.d[machines]
+        rows = self.rows[machines]
+        if (kind == CM_OP):
+            out = arg(d, self.ram[rows, a].astype(np.int64))
+        else:
+            out = arg(d, a)
+        out = np.broadcast_to(np.asarray(out, dtype=np.int64), a.shape)
+        if (dest & 1):
+            self.ram[rows, a] = out
+        if (dest & 4):
+            self.a[machines] = out
+        if (dest & 2):
+            self.d[machines] = out
+        if (jump is None):
+            self.pc[machines] = pc + 1
+        else:
+            self.pc[machines] = np.where(jump[out], a, pc + 1)
+
+
+def parseAssignment(text, machines, rand):
+    address, value = text.split("=")
+    if (":" in value):
+        low, high = value.split(":")
+        return int(address), rand.integers(int(low), int(high) + 1, machines)
+    return int(address), np.full(machines, int(value))
+
+
+if (__name__ == "__main__"):
+    args = argparse.ArgumentParser()
+    args.add_argument("filename", help=".asm, .hack or .hackb program")
+    args.add_argument("--machines", type=int, default=1000)
+    args.add_argument("--cycles", type=int, default=10000)
+    args.add_argument("--set", action="append", default=list(),
+                      metavar="ADDRESS=VALUE|LOW:HIGH",
+                      help="initialise RAM, with a random value per machine "
+                           "for LOW:HIGH")
+    args.add_argument("--seed", type=int, default=0)
+    args.add_argument("--restore", metavar="SNAPSHOT",
+                      help="start every machine from a saved state")
+    args.add_argument("--dump", action="append", default=list(),
+                      metavar="START[-END]",
+                      help="print RAM of the first machines after the run")
+    instrument.addArguments(args)
+    args = args.parse_args()
+    instrument.configure(trace, args)
+
+    rand = np.random.default_rng(args.seed)
+    with trace.phase("load"):
+        batch = BatchEmulator(loadProgram(args.filename), args.machines)
+    if (args.restore):
+        batch.restore(Snapshot(args.restore))
+    for text in args.set:
+        address, values = parseAssignment(text, args.machines, rand)
+        batch.poke(address, values)
+
+    start = int(batch.cycles.sum())
+    with trace.phase("run"):
+        batch.run(args.cycles)
+    elapsed = trace.phases["run"]
+    executed = int(batch.cycles.sum()) - start
+    trace.count("cycles", executed)
+    trace.info("{} machines, {} steps, {} cycles in {:.3f}s ({:.2f} MIPS)",
+               args.machines, batch.steps, executed, elapsed,
+               executed / max(elapsed, 1e-9) / 1e6)
+
+    for text in args.dump:
+        for address in parseRange(text):
+            print("RAM[{}] = {}".format(address, batch.peek(address)[:10]))
+    instrument.finish(trace, args)
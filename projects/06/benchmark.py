@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from assembler import Assembler, COMP, DEST, JUMP
+
+# Fraction of A-instructions that reference a label, a variable or a
+# constant, and fraction of lines that are C-instructions, per mix.
+MIXES = {
+    "label": {"labels": 0.6, "variables": 0.1, "c": 0.5, "every": 8},
+    "variable": {"labels": 0.1, "variables": 0.6, "c": 0.5, "every": 64},
+    "compute": {"labels": 0.2, "variables": 0.2, "c": 0.85, "every": 32},
+}
+PHASES = ["label", "parse", "encode", "write"]
+# Generated programs fit in ROM, so every label address fits in an
+# A-instruction.
+ROM_SIZE = 32768
+
+
+def programSize(text):
+    size = int(text)
+    if (not 0 < size <= ROM_SIZE):
+        raise argparse.ArgumentTypeError(
+            "programs are 1 to {} instructions".format(ROM_SIZE))
+    return size
+
+
+def generate(filename, size, mix, seed=0):
+    rand = random.Random(seed)
+    weights = MIXES[mix]
+    comps = [c for c in COMP]
+    dests = [d for d in DEST if d]
+    jumps = [j for j in JUMP if j]
+    labels = max(1, size // weights["every"])
+    out = open(filename, "w")
+    out.write("// synthetic {} program, {} instructions\n".format(mix, size))
+    for i in range(size):
+        if (i % weights["every"] == 0):
+            out.write("(L{})\n".format(i // weights["every"]))
+        if (rand.random() < weights["c"]):
+            if (rand.random() < 0.2):
+                out.write("D;{}\n".format(rand.choice(jumps)))
+            else:
+                out.write("{}={}\n".format(rand.choice(dests),
+                                           rand.choice(comps)))
+            continue
+        kind = rand.random()
+        if (kind < weights["labels"]):
+            out.write("@L{}\n".format(rand.randrange(labels)))
+        elif (kind < weights["labels"] + weights["variables"]):
+            out.write("@v{}\n".format(rand.randrange(size // 4 + 1)))
+        else:
+            out.write("@{}\n".format(rand.randrange(32768)))
+    out.close()
+
+
+def timePhases(filename):
+    times = dict()
+    assembler = Assembler(filename)
+    start = time.perf_counter()
+    assembler.labelPass()
+    times["label"] = time.perf_counter() - start
+
+    assembler.parser.reset()
+    start = time.perf_counter()
+    while (assembler.parser.hasMoreCommands()):
+        assembler.parser.advance()
+    times["parse"] = time.perf_counter() - start
+
+    assembler.parser.reset()
+    start = time.perf_counter()
+    assembler.words.extend(assembler.encodePass())
+    times["encode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assembler.writeWords(assembler.words)
+    times["write"] = time.perf_counter() - start
+    return times, len(assembler.words)
+
+
+def peakMemory(filename, streaming):
+    tracemalloc.start()
+    Assembler(filename, streaming).assemble()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def lastResults(filename):
+    last = dict()
+    if (not os.path.exists(filename)):
+        return last
+    with open(filename, "r") as file:
+        for line in file:
+            result = json.loads(line)
+            last[(result["mix"], result["size"])] = result
+    return last
+
+
+def report(result, previous):
+    print("{:>9} {:>9}  {:>12.0f} instr/s  peak {:>8.1f} KiB".format(
+        result["mix"], result["size"], result["rate"],
+        result["peak"] / 1024.0))
+    for phase in PHASES:
+        line = "    {:<7} {:8.4f}s".format(phase, result["times"][phase])
+        if (previous is not None and previous["times"][phase] > 0):
+            change = result["times"][phase] / previous["times"][phase] - 1
+            line += "  {:+6.1%}".format(change)
+        print(line)
+
+
+if (__name__ == "__main__"):
+    args = argparse.ArgumentParser()
+    args.add_argument("--sizes", type=programSize, nargs="+",
+                      default=[10000, ROM_SIZE],
+                      help="instructions per program, at most {}".format(
+                          ROM_SIZE))
+    args.add_argument("--mixes", nargs="+", choices=sorted(MIXES),
+                      default=sorted(MIXES))
+    args.add_argument("--repeat", type=int, default=3,
+                      help="keep the fastest of this many runs per phase")
+    args.add_argument("--stream", action="store_true",
+                      help="measure peak memory of the streaming assembler")
+    args.add_argument("--results", default="benchmark.jsonl",
+                      help="results are appended here and compared with "
+                           "the previous run")
+    args = args.parse_args()
+
+    last = lastResults(args.results)
+    workdir = tempfile.mkdtemp()
+    results = open(args.results, "a")
+    for mix in args.mixes:
+        for size in args.sizes:
+            filename = os.path.join(workdir, "{}{}.asm".format(mix, size))
+            generate(filename, size, mix)
+            best = None
+            for _ in range(args.repeat):
+                times, count = timePhases(filename)
+                if (best is None):
+                    best = times
+                best = {p: min(best[p], times[p]) for p in PHASES}
+            total = best["label"] + best["encode"] + best["write"]
+            result = {
+                "time": time.time(),
+                "mix": mix,
+                "size": size,
+                "instructions": count,
+                "times": best,
+                "rate": count / total,
+                "peak": peakMemory(filename, args.stream),
+            }
+            report(result, last.get((mix, size)))
+            results.write(json.dumps(result) + "\n")
+            os.remove(filename)
+            os.remove(filename[:-4] + ".hack")
+    results.close()
+    os.rmdir(workdir)
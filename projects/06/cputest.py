@@ -0,0 +1,124 @@
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from emulator import Emulator, loadProgram, trace
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import instrument  # noqa: E402
+from testscript import (  # noqa: E402
+    INDEXED, ScriptError, TestScript, UnsupportedScript, findFile, findTests,
+    parseValue, runTest)
+
+
+class CpuTest(TestScript):
+    def __init__(self, filename, writeOutput=True, compiled=True):
+        TestScript.__init__(self, filename, writeOutput)
+        self.compiled = compiled
+        self.emulator = Emulator()
+
+    def repeat(self, count, body):
+        if (count is None):
+            raise UnsupportedScript("interactive script")
+        if (body == [(["ticktock"], None)]):
+            self.ticks(count)
+            return
+        TestScript.repeat(self, count, body)
+
+    def ticks(self, count):
+        if (self.compiled):
+            self.emulator.runCompiled(count)
+        else:
+            self.emulator.run(count)
+
+    def clocked(self, words):
+        return words[0] in ["ticktock", "tock"]
+
+    def simulate(self, words):
+        name = words[0]
+        if (name == "load"):
+            if (len(words) < 2 or
+                    not words[1].endswith((".hack", ".asm", ".hackb"))):
+                raise UnsupportedScript("not a CPU emulator script")
+            program = findFile(self.directory, words[1])
+            self.emulator.load(loadProgram(program))
+        elif (name == "set"):
+            self.set(words[1], parseValue(words[2]))
+        elif (name in ["ticktock", "tock"]):
+            self.ticks(1)
+        elif (name == "tick"):
+            pass
+        else:
+            raise ScriptError("unknown command: " + name)
+
+    def value(self, name):
+        emulator = self.emulator
+        indexed = INDEXED.match(name)
+        if (indexed is not None and indexed.group(2)):
+            if (indexed.group(1) == "RAM"):
+                return emulator.ram[int(indexed.group(2))]
+            if (indexed.group(1) == "ROM"):
+                return emulator.rom[int(indexed.group(2))]
+        elif (name == "A"):
+            return emulator.a
+        elif (name == "D"):
+            return emulator.d
+        elif (name == "PC"):
+            return emulator.pc
+        elif (name == "time"):
+            return emulator.cycles
+        raise ScriptError("unknown variable: " + name)
+
+    def set(self, name, value):
+        emulator = self.emulator
+        indexed = INDEXED.match(name)
+        if (indexed is not None and indexed.group(1) == "RAM"):
+            emulator.poke(int(indexed.group(2)), value)
+        elif (name == "A"):
+            emulator.a = value & 0xFFFF
+        elif (name == "D"):
+            emulator.d = value & 0xFFFF
+        elif (name == "PC"):
+            emulator.pc = value
+        else:
+            raise ScriptError("cannot set " + name)
+
+
+def runCpuTest(filename, writeOutput=True, compiled=True):
+    test = CpuTest(filename, writeOutput, compiled)
+    result = runTest(test)
+    result["cycles"] = test.emulator.cycles
+    return result
+
+
+if (__name__ == "__main__"):
+    args = argparse.ArgumentParser()
+    args.add_argument("paths", nargs="+",
+                      help=".tst files or directories to search for them")
+    args.add_argument("--jobs", type=int, default=None)
+    args.add_argument("--no-output-files", action="store_true",
+                      help="compare without writing .out files")
+    args.add_argument("--interpret", action="store_true",
+                      help="do not compile basic blocks")
+    instrument.addArguments(args)
+    args = args.parse_args()
+    instrument.configure(trace, args)
+
+    tests = findTests(args.paths)
+    failed = 0
+    with ProcessPoolExecutor(args.jobs) as pool:
+        results = pool.map(runCpuTest, tests,
+                           [not args.no_output_files] * len(tests),
+                           [not args.interpret] * len(tests))
+        for result in results:
+            trace.count(result["status"])
+            if (result["status"] in ["fail", "error"]):
+                failed += 1
+            print("{:<5} {:>8.3f}s {:>10} cycles  {}".format(
+                result["status"], result["seconds"], result["cycles"],
+                result["test"]))
+            if (result["message"] and result["status"] != "skip"):
+                print("      " + result["message"])
+    instrument.finish(trace, args)
+    sys.exit(1 if failed else 0)
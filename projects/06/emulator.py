@@ -0,0 +1,451 @@
+import argparse
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+from pathlib import Path
+
+from assembler import Assembler, loadHack
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import instrument  # noqa: E402
+
+trace = instrument.Tracer("emulator")
+
+RAM_SIZE = 32768
+SCREEN = 16384
+KBD = 24576
+
+# Snapshot file: magic, version, ROM checksum, A, D, PC, cycles, RAM size,
+# then RAM as little-endian uint16.
+SNAPSHOT_MAGIC = b"HSNP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHIHHIQI")
+
+A_OP = 0
+C_OP = 1
+CM_OP = 2
+
+# ALU functions of the c-bits in a C-instruction, on x=D and y=A or M.
+# Values are kept as unsigned 16-bit ints.
+ALU = {
+    0b101010: lambda x, y: 0,
+    0b111111: lambda x, y: 1,
+    0b111010: lambda x, y: 0xFFFF,
+    0b001100: lambda x, y: x,
+    0b110000: lambda x, y: y,
+    0b001101: lambda x, y: x ^ 0xFFFF,
+    0b110001: lambda x, y: y ^ 0xFFFF,
+    0b001111: lambda x, y: -x & 0xFFFF,
+    0b110011: lambda x, y: -y & 0xFFFF,
+    0b011111: lambda x, y: (x + 1) & 0xFFFF,
+    0b110111: lambda x, y: (y + 1) & 0xFFFF,
+    0b001110: lambda x, y: (x - 1) & 0xFFFF,
+    0b110010: lambda x, y: (y - 1) & 0xFFFF,
+    0b000010: lambda x, y: (x + y) & 0xFFFF,
+    0b010011: lambda x, y: (x - y) & 0xFFFF,
+    0b000111: lambda x, y: (y - x) & 0xFFFF,
+    0b000000: lambda x, y: x & y,
+    0b010101: lambda x, y: x | y,
+}
+
+
+# The same functions as Python expression templates, for compiled blocks.
+ALU_SOURCE = {
+    0b101010: "0",
+    0b111111: "1",
+    0b111010: "65535",
+    0b001100: "{x}",
+    0b110000: "{y}",
+    0b001101: "{x} ^ 65535",
+    0b110001: "{y} ^ 65535",
+    0b001111: "-{x} & 65535",
+    0b110011: "-{y} & 65535",
+    0b011111: "({x} + 1) & 65535",
+    0b110111: "({y} + 1) & 65535",
+    0b001110: "({x} - 1) & 65535",
+    0b110010: "({y} - 1) & 65535",
+    0b000010: "({x} + {y}) & 65535",
+    0b010011: "({x} - {y}) & 65535",
+    0b000111: "({y} - {x}) & 65535",
+    0b000000: "{x} & {y}",
+    0b010101: "{x} | {y}",
+}
+JUMP_SOURCE = [
+    None,
+    "0 < v < 32768",
+    "v == 0",
+    "v < 32768",
+    "v >= 32768",
+    "v != 0",
+    "v == 0 or v >= 32768",
+    "True",
+]
+
+
+def alu(bits):
+    # Generic ALU for c-bit patterns that have no mnemonic.
+    zx, nx, zy, ny, f, no = [(bits >> (5 - i)) & 1 for i in range(6)]
+
+    def compute(x, y):
+        if (zx):
+            x = 0
+        if (nx):
+            x ^= 0xFFFF
+        if (zy):
+            y = 0
+        if (ny):
+            y ^= 0xFFFF
+        out = (x + y) & 0xFFFF if f else x & y
+        return out ^ 0xFFFF if no else out
+    return compute
+
+
+def jumpTable(condition):
+    # One byte per possible ALU output, so a jump test is a single index.
+    return bytes([condition(v) for v in range(65536)])
+
+
+JUMPS = [
+    None,
+    jumpTable(lambda v: 0 < v < 0x8000),
+    jumpTable(lambda v: v == 0),
+    jumpTable(lambda v: v < 0x8000),
+    jumpTable(lambda v: v >= 0x8000),
+    jumpTable(lambda v: v != 0),
+    jumpTable(lambda v: v == 0 or v >= 0x8000),
+    jumpTable(lambda v: True),
+]
+
+
+def decode(word):
+    if (not word & 0x8000):
+        return (A_OP, word, 0, None)
+    bits = (word >> 6) & 0x3F
+    compute = ALU.get(bits) or alu(bits)
+    kind = CM_OP if word & 0x1000 else C_OP
+    return (kind, compute, (word >> 3) & 0b111, JUMPS[word & 0b111])
+
+
+def signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def romChecksum(rom):
+    # What a snapshot records to tell which ROM it was taken with.
+    return zlib.crc32(array("H", rom).tobytes())
+
+
+def loadProgram(filename):
+    if (str(filename).endswith(".asm")):
+        return Assembler(str(filename)).program()
+    return loadHack(str(filename))
+
+
+class Emulator:
+    def __init__(self, rom=None):
+        self.ram = [0] * RAM_SIZE
+        self.rom = list()
+        self.ops = list()
+        self.reset()
+        if (rom is not None):
+            self.load(rom)
+
+    def load(self, rom):
+        # Every ROM word is decoded once, up front.
+        self.rom = list(rom)
+        self.ops = [decode(word) for word in self.rom]
+        self.blocks = dict()
+
+    def loadFile(self, filename):
+        self.load(loadProgram(filename))
+
+    def reset(self):
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.cycles = 0
+
+    def peek(self, address):
+        return signed(self.ram[address])
+
+    def poke(self, address, value):
+        self.ram[address] = value & 0xFFFF
+
+    def halted(self):
+        return self.pc >= len(self.ops)
+
+    def step(self):
+        return self.run(1)
+
+    def run(self, cycles):
+        ops = self.ops
+        ram = self.ram
+        size = len(ops)
+        a = self.a
+        d = self.d
+        pc = self.pc
+        done = 0
+        while (done < cycles and pc < size):
+            kind, arg, dest, jump = ops[pc]
+            done += 1
+            if (kind == A_OP):
+                a = arg
+                pc += 1
+                continue
+            target = a
+            if (kind == CM_OP):
+                out = arg(d, ram[a])
+            else:
+                out = arg(d, a)
+            if (dest):
+                if (dest & 1):
+                    ram[a] = out
+                if (dest & 4):
+                    a = out
+                if (dest & 2):
+                    d = out
+            if (jump is not None and jump[out]):
+                pc = target
+            else:
+                pc += 1
+        self.a = a
+        self.d = d
+        self.pc = pc
+        self.cycles += done
+        return done
+
+    def runCompiled(self, cycles):
+        # Runs straight-line code as compiled blocks, one Python call per
+        # block. The interpreter finishes any remainder that is shorter than
+        # the next block, so cycle budgets are exact.
+        blocks = self.blocks
+        ram = self.ram
+        size = len(self.ops)
+        a = self.a
+        d = self.d
+        pc = self.pc
+        done = 0
+        while (pc < size):
+            block = blocks.get(pc)
+            if (block is None):
+                block = self.compileBlock(pc)
+            function, length = block
+            if (done + length > cycles):
+                break
+            a, d, pc = function(ram, a, d)
+            done += length
+        self.a = a
+        self.d = d
+        self.pc = pc
+        self.cycles += done
+        if (done < cycles):
+            done += self.run(cycles - done)
+        return done
+
+    def runUntil(self, stops, cycles, counts=None):
+        # Runs compiled blocks until one jumps to an address in stops or
+        # the budget would be overrun. Stops are only seen at block
+        # boundaries, which a jump target always is. counts, if given, is
+        # a Counter of how often each block start ran.
+        blocks = self.blocks
+        ram = self.ram
+        size = len(self.ops)
+        a = self.a
+        d = self.d
+        pc = self.pc
+        done = 0
+        while (pc < size and pc not in stops):
+            block = blocks.get(pc)
+            if (block is None):
+                block = self.compileBlock(pc)
+            function, length = block
+            if (done + length > cycles):
+                break
+            if (counts is not None):
+                counts[pc] += 1
+            a, d, pc = function(ram, a, d)
+            done += length
+        self.a = a
+        self.d = d
+        self.pc = pc
+        self.cycles += done
+        return done
+
+    def compileBlock(self, start):
+        # A block runs from start up to and including the first jump. ROM
+        # is read-only in Hack, so a block only needs recompiling when a new
+        # program is loaded. Constants loaded into A are folded into the
+        # code and only stored to a when the block returns.
+        namespace = dict()
+        lines = ["def block(ram, a, d):"]
+        known = None
+        pc = start
+        end = None
+        while (end is None and pc < len(self.rom)):
+            word = self.rom[pc]
+            pc += 1
+            if (not word & 0x8000):
+                known = str(word)
+                continue
+            bits = (word >> 6) & 0x3F
+            dest = (word >> 3) & 0b111
+            jump = word & 0b111
+            address = known or "a"
+            y = "ram[{}]".format(address) if word & 0x1000 else address
+            if (bits in ALU_SOURCE):
+                expression = ALU_SOURCE[bits].format(x="d", y=y)
+            else:
+                name = "alu{}".format(bits)
+                namespace[name] = alu(bits)
+                expression = "{}(d, {})".format(name, y)
+            target = address
+            if (jump and dest & 4 and known is None):
+                lines.append("    t = a")
+                target = "t"
+            if (not jump and dest in [1, 2, 4]):
+                register = {1: "ram[{}]".format(address), 2: "d", 4: "a"}
+                lines.append("    {} = {}".format(register[dest], expression))
+            elif (dest or jump):
+                lines.append("    v = " + expression)
+                if (dest & 1):
+                    lines.append("    ram[{}] = v".format(address))
+                if (dest & 4):
+                    lines.append("    a = v")
+                if (dest & 2):
+                    lines.append("    d = v")
+            if (dest & 4):
+                known = None
+            if (jump == 0b111):
+                end = "    return {}, d, {}".format(known or "a", target)
+            elif (jump):
+                lines.append("    if ({}):".format(JUMP_SOURCE[jump]))
+                lines.append("        return {}, d, {}".format(known or "a",
+                                                               target))
+                end = "    return {}, d, {}".format(known or "a", pc)
+        lines.append(end or "    return {}, d, {}".format(known or "a", pc))
+        exec("\n".join(lines), namespace)
+        block = (namespace["block"], pc - start)
+        self.blocks[start] = block
+        trace.count("blocks")
+        return block
+
+    def romChecksum(self):
+        return romChecksum(self.rom)
+
+    def save(self, filename):
+        ram = array("H", self.ram)
+        if (sys.byteorder != "little"):
+            ram.byteswap()
+        with open(filename, "wb") as out:
+            out.write(SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.romChecksum(), self.a,
+                self.d, self.pc, self.cycles, len(ram)))
+            out.write(ram.tobytes())
+
+    def restore(self, filename):
+        Snapshot(filename).restore(self)
+
+
+class Snapshot:
+    # A saved machine state, mapped rather than read so a warmed-up state
+    # can be forked into many runs. The RAM words are unpacked once and
+    # each restore is a single list copy.
+    def __init__(self, filename):
+        with open(filename, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.checksum, self.a, self.d, self.pc, self.cycles,
+         size) = SNAPSHOT_HEADER.unpack_from(self.data)
+        if (magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION):
+            raise ValueError("not a snapshot file: " + filename)
+        start = SNAPSHOT_HEADER.size
+        self.buffer = memoryview(self.data)[start:start + 2 * size]
+        if (sys.byteorder == "little"):
+            self.ram = self.buffer.cast("H").tolist()
+        else:
+            ram = array("H", self.buffer)
+            ram.byteswap()
+            self.ram = ram.tolist()
+        self.checked = None
+
+    def restore(self, emulator):
+        if (emulator.rom is not self.checked):
+            if (emulator.rom and emulator.romChecksum() != self.checksum):
+                raise ValueError("snapshot was taken with a different ROM")
+            self.checked = emulator.rom
+        emulator.ram[:] = self.ram
+        emulator.a = self.a
+        emulator.d = self.d
+        emulator.pc = self.pc
+        emulator.cycles = self.cycles
+
+
+def parseRange(text):
+    if ("-" in text):
+        start, end = text.split("-")
+        return range(int(start), int(end) + 1)
+    return range(int(text), int(text) + 1)
+
+
+if (__name__ == "__main__"):
+    args = argparse.ArgumentParser()
+    args.add_argument("filename", help=".asm, .hack or .hackb program")
+    args.add_argument("--cycles", type=int, default=1000000)
+    args.add_argument("--set", action="append", default=list(),
+                      metavar="ADDRESS=VALUE", help="initialise RAM")
+    args.add_argument("--dump", action="append", default=list(),
+                      metavar="START[-END]", help="print RAM after the run")
+    args.add_argument("--compile", action="store_true",
+                      help="run basic blocks as compiled Python functions")
+    args.add_argument("--frames", metavar="DIRECTORY",
+                      help="save the screen here every --frame-interval")
+    args.add_argument("--frame-interval", type=int, default=100000,
+                      metavar="CYCLES")
+    args.add_argument("--frame-format", choices=["pbm", "png"],
+                      default="pbm")
+    args.add_argument("--restore", metavar="SNAPSHOT",
+                      help="start from a saved machine state")
+    args.add_argument("--snapshot", metavar="SNAPSHOT",
+                      help="save the machine state after the run")
+    instrument.addArguments(args)
+    args = args.parse_args()
+    instrument.configure(trace, args)
+
+    with trace.phase("load"):
+        emulator = Emulator()
+        emulator.loadFile(args.filename)
+    if (args.restore):
+        emulator.restore(args.restore)
+    for assignment in args.set:
+        address, value = assignment.split("=")
+        emulator.poke(int(address), int(value))
+
+    recorder = None
+    interval = args.cycles
+    if (args.frames):
+        from screen import FrameRecorder
+        recorder = FrameRecorder(args.frames, args.frame_format)
+        interval = args.frame_interval
+    run = emulator.runCompiled if args.compile else emulator.run
+    remaining = args.cycles
+    while (remaining > 0 and not emulator.halted()):
+        with trace.phase("run"):
+            remaining -= run(min(interval, remaining))
+        if (recorder is not None):
+            with trace.phase("frames"):
+                recorder.capture(emulator.ram)
+    if (recorder is not None):
+        trace.count("frames", recorder.count)
+    if (args.snapshot):
+        emulator.save(args.snapshot)
+    elapsed = trace.phases.get("run", 0.0)
+    trace.count("cycles", emulator.cycles)
+    trace.count("rom", len(emulator.rom))
+    trace.info("{} cycles in {:.3f}s ({:.2f} MIPS)", emulator.cycles, elapsed,
+               emulator.cycles / max(elapsed, 1e-9) / 1e6)
+
+    for text in args.dump:
+        for address in parseRange(text):
+            print("RAM[{}] = {}".format(address, emulator.peek(address)))
+    instrument.finish(trace, args)
@@ -0,0 +1,165 @@
+import argparse
+import os
+import sys
+from collections import Counter
+from pathlib import Path
+
+from assembler import loadSourceMap, readSourceMap
+from emulator import Emulator, loadProgram, trace
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import instrument  # noqa: E402
+
+# The function the translator's shared call and return routines belong to.
+RUNTIME = "(runtime)"
+
+
+class Profiler:
+    # Attributes the cycles of an emulator run to VM functions through a
+    # source map. A shadow call stack is pushed when the jump that ends a
+    # VM call is taken and popped at the jump that ends a return. Both are
+    # unconditional and end a compiled block, so the stack is only checked
+    # once per block and cycles are charged to it in bulk. With shared call
+    # routines the jump into the routine is passed over and the routine's
+    # own jump out moves the stack, so their cycles go to the caller on a
+    # call and to the callee on a return, as when they are inlined.
+    def __init__(self, emulator, entries):
+        self.emulator = emulator
+        self.owner = ["?"] * len(emulator.rom)
+        self.calls = set()
+        self.returns = set()
+        for start, end, source, line, function, command in entries:
+            for address in range(start, min(end, len(self.owner))):
+                self.owner[address] = function
+            if (command.split(" ")[0] == "call"):
+                self.calls.add(end - 1)
+            elif (command == "return"):
+                self.returns.add(end - 1)
+        self.stack = [self.functionAt(emulator.pc)]
+        self.stacks = Counter()
+        self.callCounts = Counter()
+
+    def functionAt(self, pc):
+        return self.owner[pc] if pc < len(self.owner) else "?"
+
+    def run(self, cycles):
+        emulator = self.emulator
+        blocks = emulator.blocks
+        ram = emulator.ram
+        size = len(emulator.ops)
+        a = emulator.a
+        d = emulator.d
+        pc = emulator.pc
+        done = 0
+        charged = 0
+        while (pc < size):
+            block = blocks.get(pc)
+            if (block is None):
+                block = emulator.compileBlock(pc)
+            function, length = block
+            if (done + length > cycles):
+                break
+            last = pc + length - 1
+            a, d, pc = function(ram, a, d)
+            done += length
+            if (last in self.calls or last in self.returns):
+                self.stacks[tuple(self.stack)] += done - charged
+                charged = done
+                self.transfer(last, pc)
+        emulator.a = a
+        emulator.d = d
+        emulator.pc = pc
+        emulator.cycles += done
+        # Step the remainder so a call or return in it is still seen.
+        while (done < cycles and not emulator.halted()):
+            last = emulator.pc
+            emulator.run(1)
+            done += 1
+            if (last in self.calls or last in self.returns):
+                self.stacks[tuple(self.stack)] += done - charged
+                charged = done
+                self.transfer(last, emulator.pc)
+        self.stacks[tuple(self.stack)] += done - charged
+        return done
+
+    def transfer(self, last, pc):
+        if (self.functionAt(pc) == RUNTIME):
+            return
+        if (last in self.calls):
+            function = self.functionAt(pc)
+            self.stack.append(function)
+            self.callCounts[function] += 1
+        elif (len(self.stack) > 1):
+            self.stack.pop()
+        # A run restored mid-call has no record of its callers, so the
+        # stack is re-rooted at whatever function it returns into.
+        self.stack[-1] = self.functionAt(pc)
+
+    def flat(self):
+        # (function, calls, self cycles, total cycles), by self cycles.
+        own = Counter()
+        total = Counter()
+        for stack, cycles in self.stacks.items():
+            own[stack[-1]] += cycles
+            for function in set(stack):
+                total[function] += cycles
+        rows = [(f, self.callCounts[f], own[f], total[f]) for f in total]
+        rows.sort(key=lambda row: (-row[2], row[0]))
+        return rows
+
+    def writeFlat(self, out):
+        cycles = sum(self.stacks.values()) or 1
+        out.write("{:>7} {:>12} {:>7} {:>12} {:>9}  {}\n".format(
+            "self%", "self", "total%", "total", "calls", "function"))
+        for function, calls, own, total in self.flat():
+            out.write("{:>6.2f}% {:>12} {:>6.2f}% {:>12} {:>9}  {}\n".format(
+                100.0 * own / cycles, own, 100.0 * total / cycles, total,
+                calls, function))
+
+    def writeCollapsed(self, filename):
+        # One "caller;callee count" line per stack, the input format of
+        # flamegraph.pl and speedscope.
+        with open(filename, "w") as out:
+            for stack, cycles in sorted(self.stacks.items()):
+                if (cycles):
+                    out.write("{} {}\n".format(";".join(stack), cycles))
+
+
+def sourceMap(program, filename=None):
+    if (filename is None):
+        filename = os.path.splitext(program)[0] + ".map"
+        if (not os.path.exists(filename) and program.endswith(".asm")):
+            with open(program, "r") as file:
+                return readSourceMap(file)
+    return loadSourceMap(filename)
+
+
+if (__name__ == "__main__"):
+    args = argparse.ArgumentParser()
+    args.add_argument("filename", help=".asm, .hack or .hackb program")
+    args.add_argument("--map", help="source map from assembler.py "
+                                    "--source-map, by default next to the "
+                                    "program or read from its .asm markers")
+    args.add_argument("--cycles", type=int, default=1000000)
+    args.add_argument("--restore", metavar="SNAPSHOT",
+                      help="start from a saved machine state")
+    args.add_argument("--collapsed", metavar="FILE",
+                      help="write collapsed stacks for a flame graph")
+    instrument.addArguments(args)
+    args = args.parse_args()
+    instrument.configure(trace, args)
+
+    with trace.phase("load"):
+        emulator = Emulator(loadProgram(args.filename))
+        entries = sourceMap(args.filename, args.map)
+    if (args.restore):
+        emulator.restore(args.restore)
+    profiler = Profiler(emulator, entries)
+    with trace.phase("run"):
+        profiler.run(args.cycles)
+    trace.count("cycles", emulator.cycles)
+    trace.count("calls", sum(profiler.callCounts.values()))
+    profiler.writeFlat(sys.stdout)
+    if (args.collapsed):
+        profiler.writeCollapsed(args.collapsed)
+    instrument.finish(trace, args)
@@ -0,0 +1,61 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from emulator import SCREEN, KBD
+
+WIDTH = 512
+HEIGHT = 256
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def framebuffer(ram):
+    # The screen map as a HEIGHT x WIDTH array of 0/1 pixels, 1 = black.
+    # Each word holds 16 pixels with the leftmost in the least significant
+    # bit, so unpacking little-endian bytes little-bit-first keeps order.
+    words = np.array(ram[SCREEN:KBD], dtype="<u2")
+    bits = np.unpackbits(words.view(np.uint8), bitorder="little")
+    return bits.reshape(HEIGHT, WIDTH)
+
+
+def writePbm(filename, bitmap):
+    with open(filename, "wb") as out:
+        out.write("P4\n{} {}\n".format(WIDTH, HEIGHT).encode())
+        out.write(np.packbits(bitmap, axis=1).tobytes())
+
+
+def pngChunk(kind, data):
+    crc = zlib.crc32(kind + data) & 0xFFFFFFFF
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", crc)
+
+
+def writePng(filename, bitmap):
+    # 1-bit grayscale, where 0 is black, with filter type 0 on every row.
+    rows = np.packbits(1 - bitmap, axis=1)
+    raw = np.hstack([np.zeros((HEIGHT, 1), dtype=np.uint8), rows])
+    header = struct.pack(">IIBBBBB", WIDTH, HEIGHT, 1, 0, 0, 0, 0)
+    with open(filename, "wb") as out:
+        out.write(PNG_SIGNATURE)
+        out.write(pngChunk(b"IHDR", header))
+        out.write(pngChunk(b"IDAT", zlib.compress(raw.tobytes())))
+        out.write(pngChunk(b"IEND", b""))
+
+
+WRITERS = {"pbm": writePbm, "png": writePng}
+
+
+class FrameRecorder:
+    def __init__(self, directory, format="pbm"):
+        self.directory = directory
+        self.format = format
+        self.count = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def capture(self, ram):
+        filename = os.path.join(self.directory, "frame{:06d}.{}".format(
+            self.count, self.format))
+        WRITERS[self.format](filename, framebuffer(ram))
+        self.count += 1
+        return filename
@@ -0,0 +1,285 @@
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+from array import array
+from collections import Counter
+from pathlib import Path
+
+PROJECTS = Path(__file__).resolve().parent.parent
+sys.path.append(str(PROJECTS / "06"))
+from assembler import AddressError, Assembler, readSourceMap  # noqa: E402
+from emulator import Emulator  # noqa: E402
+from peephole import RULES  # noqa: E402
+from translator import CodeWriter, translate  # noqa: E402
+
+# CodeWriter options of each translation, compared against the first.
+MODES = {
+    "inline": {},
+    "shared-compare": {"sharedCompare": True},
+    "shared-all": {"sharedCalls": True, "sharedCompare": True},
+    "peephole": {"peephole": True},
+    "peephole-all": {"sharedCalls": True, "sharedCompare": True,
+                     "peephole": True},
+}
+PROGRAMS = [
+    "08/FunctionCalls/FibonacciElement",
+    "08/FunctionCalls/NestedCall",
+    "08/FunctionCalls/StaticsTest",
+    "11/Seven",
+    "11/ConvertToBin",
+    "11/ComplexArrays",
+]
+# A run ends on reaching one of these labels or a "label X; goto X" loop.
+STOPS = ["Sys.halt"]
+JUMP = 0b1110101010000111
+ROM_SIZE = 32768
+# The rule named at the end of a fused command's source map entry.
+FUSED = re.compile(r"\[([\w-]+)\]$")
+
+# A bubble sort of pseudo-random values at RAM[2048], which fits in ROM in
+# every mode and spends most of its time on comparisons and loops.
+SORT = """function Sys.init 0
+call Sort.fill 0
+pop temp 0
+call Sort.sort 0
+pop temp 0
+label HALT
+goto HALT
+
+function Sort.fill 1
+push constant 7
+pop static 0
+label FILL
+push local 0
+push constant {size}
+eq
+if-goto FILLED
+push static 0
+push static 0
+add
+push static 0
+add
+push constant 1237
+add
+push constant 2047
+and
+pop static 0
+push constant 2048
+push local 0
+add
+pop pointer 1
+push static 0
+pop that 0
+push local 0
+push constant 1
+add
+pop local 0
+goto FILL
+label FILLED
+push constant 0
+return
+
+function Sort.sort 3
+label OUTER
+push local 0
+push constant {last}
+lt
+not
+if-goto SORTED
+push constant 0
+pop local 1
+label INNER
+push local 1
+push constant {last}
+push local 0
+sub
+lt
+not
+if-goto NEXT
+push constant 2048
+push local 1
+add
+pop pointer 1
+push that 0
+push that 1
+gt
+not
+if-goto KEEP
+push that 0
+pop local 2
+push that 1
+pop that 0
+push local 2
+pop that 1
+label KEEP
+push local 1
+push constant 1
+add
+pop local 1
+goto INNER
+label NEXT
+push local 0
+push constant 1
+add
+pop local 0
+goto OUTER
+label SORTED
+push constant 0
+return
+"""
+
+
+def generateSort(directory, size):
+    os.makedirs(directory)
+    with open(os.path.join(directory, "Sort.vm"), "w") as out:
+        out.write(SORT.format(size=size, last=size - 1))
+
+
+def build(directory, workdir, options):
+    files = sorted(p for p in Path(directory).iterdir()
+                   if p.name.endswith(".vm"))
+    filename = os.path.join(workdir, Path(directory).name + ".asm")
+    codewriter = CodeWriter(filename, **options)
+    translate(files, codewriter)
+    codewriter.close()
+    assembler = Assembler(filename)
+    try:
+        assembler.assemble()
+    except AddressError:
+        # Labels past ROM do not fit in A-instructions, so the program is
+        # only counted; callers see more words than ROM_SIZE.
+        assembler = Assembler(filename)
+        assembler.labelPass()
+        assembler.words = [None] * assembler.count
+    return assembler
+
+
+def stopAddresses(assembler):
+    words = assembler.words
+    stops = set(i for i in range(len(words) - 1)
+                if words[i] == i and words[i + 1] == JUMP)
+    for label in STOPS:
+        if (assembler.symbols.contains(label)):
+            stops.add(assembler.symbols.getAddress(label))
+    return stops
+
+
+def measure(directory, workdir, options, cycles):
+    # (ROM words, cycles to the end of the run or None when it does not
+    # fit in ROM, whether the run ended within the budget).
+    assembler = build(directory, workdir, options)
+    words = len(assembler.words)
+    if (words > ROM_SIZE):
+        return words, None, False
+    emulator = Emulator(array("H", assembler.words))
+    stops = stopAddresses(assembler)
+    emulator.runUntil(stops, cycles)
+    return words, emulator.cycles, emulator.pc in stops
+
+
+def profile(directory, workdir, options, cycles):
+    # The source map entries of a build with the cycles run in each, or
+    # None when it does not fit in ROM.
+    assembler = build(directory, workdir, dict(options, sourceMap=True))
+    words = len(assembler.words)
+    if (words > ROM_SIZE):
+        return None
+    with open(assembler.filename, "r") as file:
+        entries = readSourceMap(file)
+    emulator = Emulator(array("H", assembler.words))
+    counts = Counter()
+    emulator.runUntil(stopAddresses(assembler), cycles, counts)
+    # Every instruction of a block runs each time the block does.
+    runs = [0] * (words + 1)
+    for start, count in counts.items():
+        runs[start] += count
+        runs[start + emulator.blocks[start][1]] -= count
+    for address in range(1, words):
+        runs[address] += runs[address - 1]
+    return [(entry, sum(runs[entry[0]:entry[1]])) for entry in entries]
+
+
+def ruleSavings(baseline, optimized):
+    # rule name -> [sites, words saved, cycles saved], comparing each fused
+    # command with the commands it replaced in the baseline build.
+    position = {(e[2], e[3]): i for i, (e, _) in enumerate(baseline)}
+    savings = {rule.name: [0, 0, 0] for rule in RULES}
+    for (start, end, source, line, _, command), cycles in optimized:
+        match = FUSED.search(command)
+        if (match is None):
+            continue
+        i = position[(source, line)]
+        replaced = baseline[i:i + command.count(" / ") + 1]
+        saving = savings[match.group(1)]
+        saving[0] += 1
+        saving[1] += sum(e[1] - e[0] for e, _ in replaced) - (end - start)
+        saving[2] += sum(c for _, c in replaced) - cycles
+    return savings
+
+
+def reportRules(program, savings):
+    print("{:<18} {:<15} {:>7} {:>8} {:>11}".format(
+        Path(program).name, "rule", "sites", "words", "cycles"))
+    for name, (sites, words, cycles) in savings.items():
+        print("{:<18} {:<15} {:>7} {:>8} {:>11}".format(
+            "", name, sites, -words, -cycles))
+
+
+def change(value, base):
+    if (value is None or not base):
+        return ""
+    return "{:+7.1%}".format(value / base - 1)
+
+
+if (__name__ == "__main__"):
+    args = argparse.ArgumentParser()
+    args.add_argument("programs", nargs="*",
+                      default=[str(PROJECTS / p) for p in PROGRAMS],
+                      help="directories of .vm files with a Sys.init")
+    args.add_argument("--sort", type=int, default=64, metavar="SIZE",
+                      help="also run a generated bubble sort of SIZE "
+                           "values, or 0 for none")
+    args.add_argument("--modes", nargs="+", choices=list(MODES),
+                      default=list(MODES))
+    args.add_argument("--cycles", type=int, default=50000000,
+                      help="cycle budget of each run")
+    args.add_argument("--rules", action="store_true",
+                      help="report the words and cycles each peephole "
+                           "rule changed against the inline translation")
+    args = args.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    programs = list(args.programs)
+    if (args.sort):
+        programs.insert(0, os.path.join(workdir, "Sort"))
+        generateSort(programs[0], args.sort)
+    print("{:<18} {:<15} {:>7} {:>8} {:>11} {:>8}".format(
+        "program", "mode", "words", "", "cycles", ""))
+    for program in programs:
+        base = None
+        for mode in args.modes:
+            words, cycles, ended = measure(program, workdir, MODES[mode],
+                                           args.cycles)
+            if (base is None):
+                base = (words, cycles)
+            if (cycles is None):
+                shown = "too big"
+            else:
+                shown = str(cycles) + ("" if ended else "+")
+            print("{:<18} {:<15} {:>7} {:>8} {:>11} {:>8}".format(
+                Path(program).name, mode, words, change(words, base[0]),
+                shown, change(cycles, base[1])))
+    if (args.rules):
+        for program in programs:
+            baseline = profile(program, workdir, MODES["inline"],
+                               args.cycles)
+            optimized = profile(program, workdir, MODES["peephole"],
+                                args.cycles)
+            if (baseline is None or optimized is None):
+                continue
+            print()
+            reportRules(program, ruleSavings(baseline, optimized))
+    shutil.rmtree(workdir)
@@ -0,0 +1,179 @@
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+from array import array
+from pathlib import Path
+
+PROJECTS = Path(__file__).resolve().parent.parent
+sys.path.append(str(PROJECTS / "06"))
+from assembler import Assembler  # noqa: E402
+from benchmark import stopAddresses  # noqa: E402
+from emulator import Emulator  # noqa: E402
+from peephole import RULES  # noqa: E402
+from translator import CodeWriter, translate  # noqa: E402
+
+# Runs random VM programs translated inline and with the options below, and
+# reports any whose final machine state differs.
+MODES = {
+    "peephole": {"peephole": True},
+    "peephole-all": {"sharedCalls": True, "sharedCompare": True,
+                     "peephole": True},
+}
+# Segments the programs read and write, with the indexes they use.
+SEGMENTS = [("local", 4), ("argument", 3), ("this", 8), ("that", 8),
+            ("temp", 8), ("static", 4)]
+CONSTANTS = [0, 1, 2, 7, 100, 32767]
+# this and that point at these, set up before the generated statements.
+THIS = 3000
+THAT = 4000
+CYCLES = 1000000
+
+
+class Generator:
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.labels = 0
+
+    def operand(self):
+        if (self.random.random() < 0.35):
+            return "constant {}".format(self.random.choice(
+                CONSTANTS + [self.random.randrange(32768)]))
+        return self.target()
+
+    def target(self):
+        segment, size = self.random.choice(SEGMENTS)
+        return "{} {}".format(segment, self.random.randrange(size))
+
+    def value(self, depth=0):
+        # Commands that leave exactly one more value on the stack.
+        r = self.random.random()
+        if (depth > 2 or r < 0.3):
+            return ["push " + self.operand()]
+        if (r < 0.45):
+            return self.value(depth + 1) + [
+                self.random.choice(["not", "neg"])]
+        if (r < 0.7):
+            return self.value(depth + 1) + [
+                "push constant {}".format(self.random.choice([1, 5, 255])),
+                self.random.choice(["add", "sub", "and", "or"])]
+        return self.value(depth + 1) + self.value(depth + 1) + [
+            self.random.choice(["add", "sub", "and", "or", "eq", "lt",
+                                "gt"])]
+
+    def statement(self):
+        r = self.random.random()
+        if (r < 0.4):
+            return self.value() + ["pop " + self.target()]
+        if (r < 0.5):
+            # An update in place, e.g. i = i + 1.
+            target = self.target()
+            return ["push " + target,
+                    "push constant {}".format(self.random.choice([1, 5])),
+                    self.random.choice(["add", "sub", "and", "or"]),
+                    "pop " + target]
+        if (r < 0.6):
+            return ["push constant {}".format(
+                        self.random.choice([THIS, THIS + 8])),
+                    "pop pointer {}".format(self.random.randrange(2))]
+        if (r < 0.85):
+            label = "L{}".format(self.labels)
+            self.labels += 1
+            body = list()
+            for _ in range(self.random.randrange(3)):
+                body += self.statement()
+            negate = ["not"] if self.random.random() < 0.4 else []
+            return (self.value() + negate + ["if-goto " + label] + body +
+                    ["label " + label])
+        return (self.value() + self.value() +
+                ["pop " + self.target(), "pop " + self.target()])
+
+    def program(self):
+        lines = ["function Sys.init 0",
+                 "push constant 11",
+                 "push constant 22",
+                 "push constant 33",
+                 "call Test.run 3",
+                 "label END",
+                 "goto END",
+                 "function Test.run 4",
+                 "push constant {}".format(THIS),
+                 "pop pointer 0",
+                 "push constant {}".format(THAT),
+                 "pop pointer 1"]
+        for _ in range(self.random.randrange(5, 30)):
+            lines += self.statement()
+        # Leave a few values on the stack to compare as well.
+        for _ in range(self.random.randrange(4)):
+            lines += self.value()
+        lines += ["label SPIN", "goto SPIN"]
+        return "\n".join(lines) + "\n"
+
+
+def build(directory, options, rules=None):
+    filename = os.path.join(directory, "Test.asm")
+    codewriter = CodeWriter(filename, **options)
+    if (rules is not None):
+        codewriter.rules = rules
+    translate([Path(directory) / "Test.vm"], codewriter)
+    codewriter.close()
+    assembler = Assembler(filename)
+    assembler.assemble()
+    return assembler
+
+
+def state(assembler):
+    # The machine state a correct translation must agree on: Test.run's
+    # stack and segments, the temp segment, and the statics. Statics are
+    # read through the symbol table since their addresses differ by mode.
+    emulator = Emulator(array("H", assembler.words))
+    emulator.runUntil(stopAddresses(assembler), CYCLES)
+    ram = emulator.ram
+    sp, lcl, arg = ram[0], ram[1], ram[2]
+    statics = list()
+    for i in range(4):
+        name = "Test.{}".format(i)
+        if (assembler.symbols.contains(name)):
+            statics.append(ram[assembler.symbols.getAddress(name)])
+        else:
+            statics.append(None)
+    return (sp - lcl, ram[3], ram[4], ram[lcl:sp], ram[arg:arg + 3],
+            ram[THIS:THIS + 16], ram[THAT:THAT + 16], ram[5:13], statics)
+
+
+def check(directory, seed, variants):
+    # Names of the variants that disagree with the inline translation.
+    with open(os.path.join(directory, "Test.vm"), "w") as out:
+        out.write(Generator(seed).program())
+    expected = state(build(directory, {}))
+    return [name for name, (options, rules) in variants.items()
+            if state(build(directory, options, rules)) != expected]
+
+
+if (__name__ == "__main__"):
+    args = argparse.ArgumentParser()
+    args.add_argument("count", type=int, nargs="?", default=300,
+                      help="number of random programs")
+    args.add_argument("--seed", type=int, default=0,
+                      help="seed of the first program")
+    args.add_argument("--rules", action="store_true",
+                      help="also check each peephole rule on its own")
+    args = args.parse_args()
+
+    variants = {name: (options, None) for name, options in MODES.items()}
+    if (args.rules):
+        for rule in RULES:
+            variants[rule.name] = ({"peephole": True}, [rule])
+    workdir = tempfile.mkdtemp()
+    failed = 0
+    for seed in range(args.seed, args.seed + args.count):
+        mismatches = check(workdir, seed, variants)
+        if (mismatches):
+            failed += 1
+            print("seed {}: {} differ from inline".format(
+                seed, ", ".join(mismatches)))
+    shutil.rmtree(workdir)
+    print("{} programs, {} mismatched".format(args.count, failed))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,331 @@
+# Rewrites runs of VM commands into fused pseudo-commands with shorter
+# Hack code. Commands are (line, text, command, arg1, arg2) tuples as read
+# by translator.readCommands(); a fused command is
+# (line, text, "C_FUSED", rule, commands) for the commands it replaces.
+
+# Segments at fixed RAM addresses, and those reached through a pointer.
+FIXED = {"pointer": 3, "temp": 5}
+POINTERS = {"local": "LCL", "argument": "ARG", "this": "THIS",
+            "that": "THAT"}
+OPERATORS = {"add": "D+M", "sub": "M-D", "and": "D&M", "or": "D|M"}
+CONSTANT_OPERATORS = {"add": "D+A", "sub": "D-A", "and": "D&A", "or": "D|A"}
+# Values an instruction can write without loading them into D.
+LITERALS = {"0": "0", "1": "1"}
+JUMPS = {"eq": "JEQ", "lt": "JLT", "gt": "JGT"}
+NEGATED = {"eq": "JNE", "lt": "JGE", "gt": "JLE"}
+
+
+def isPush(command, segment=None):
+    return (command[2] == "C_PUSH" and
+            (segment is None or command[3] == segment))
+
+
+def isPop(command):
+    return command[2] == "C_POP"
+
+
+def isArithmetic(command, names):
+    return command[2] == "C_ARITHMETIC" and command[3] in names
+
+
+def load(writer, lines, segment, index):
+    # Sets D to the value a push of segment index would push.
+    if (segment == "constant"):
+        lines.append("@" + index)
+        lines.append("D=A")
+    elif (select(writer, lines, segment, index)):
+        lines.append("D=M")
+    else:
+        lines.append("@" + POINTERS[segment])
+        lines.append("D=M")
+        lines.append("@" + index)
+        lines.append("A=D+A")
+        lines.append("D=M")
+
+
+def select(writer, lines, segment, index):
+    # Sets A to the address of segment index without using D, when that
+    # takes at most three instructions. Returns whether it did.
+    if (segment in FIXED):
+        lines.append("@{}".format(FIXED[segment] + int(index)))
+    elif (segment == "static"):
+        lines.append("@{}.{}".format(writer.getCurrentFilePrefix(), index))
+    elif (segment in POINTERS and int(index) <= 2):
+        lines.append("@" + POINTERS[segment])
+        if (index == "0"):
+            lines.append("A=M")
+        else:
+            lines.append("A=M+1")
+        if (index == "2"):
+            lines.append("A=A+1")
+    else:
+        return False
+    return True
+
+
+def store(writer, lines, segment, index, value):
+    # Appends value, code leaving the value to store in D, and the store
+    # to segment index.
+    if (select(writer, list(), segment, index)):
+        lines.extend(value)
+        select(writer, lines, segment, index)
+        lines.append("M=D")
+        return
+    # The address needs D, so it is computed first and kept in R13.
+    lines.append("@" + POINTERS[segment])
+    lines.append("D=M")
+    lines.append("@" + index)
+    lines.append("D=D+A")
+    lines.append("@R13")
+    lines.append("M=D")
+    lines.extend(value)
+    lines.append("@R13")
+    lines.append("A=M")
+    lines.append("M=D")
+
+
+def pushD(lines):
+    lines.append("@SP")
+    lines.append("AM=M+1")
+    lines.append("A=A-1")
+    lines.append("M=D")
+
+
+def popD(lines):
+    lines.append("@SP")
+    lines.append("AM=M-1")
+    lines.append("D=M")
+
+
+def label(writer, name):
+    return "{}${}".format(writer.function_name_stack[-1], name)
+
+
+class Rule:
+    # match() returns how many commands from position i the rule fuses,
+    # or 0; lines() returns the Hack code of the fused commands.
+    name = None
+
+    def match(self, commands, i):
+        return 0
+
+    def lines(self, writer, commands):
+        return list()
+
+
+class Update(Rule):
+    # push x / push constant c / add|sub|and|or / pop y
+    name = "update"
+
+    def match(self, commands, i):
+        window = commands[i:i + 4]
+        if (len(window) == 4 and isPush(window[0]) and
+                isPush(window[1], "constant") and
+                isArithmetic(window[2], CONSTANT_OPERATORS) and
+                isPop(window[3])):
+            return 4
+        return 0
+
+    def lines(self, writer, commands):
+        source, constant, operator, target = commands
+        lines = list()
+        operator = operator[3]
+        if (source[3:] == target[3:] and
+                select(writer, lines, target[3], target[4])):
+            # In place, e.g. i = i + 1.
+            if (constant[4] == "1" and operator in ["add", "sub"]):
+                lines.append("M=M+1" if operator == "add" else "M=M-1")
+                return lines
+            lines = ["@" + constant[4], "D=A"]
+            select(writer, lines, target[3], target[4])
+            lines.append("M=" + OPERATORS[operator])
+            return lines
+        value = list()
+        load(writer, value, source[3], source[4])
+        value.append("@" + constant[4])
+        value.append("D=" + CONSTANT_OPERATORS[operator])
+        store(writer, lines, target[3], target[4], value)
+        return lines
+
+
+class CompareNotIf(Rule):
+    # eq|lt|gt / not / if-goto: jumps when the comparison is false.
+    name = "compare-not-if"
+
+    def match(self, commands, i):
+        window = commands[i:i + 3]
+        if (len(window) == 3 and isArithmetic(window[0], JUMPS) and
+                isArithmetic(window[1], ["not"]) and window[2][2] == "C_IF"):
+            return 3
+        return 0
+
+    def lines(self, writer, commands):
+        return compareJump(writer, commands[-1][3],
+                           NEGATED[commands[0][3]])
+
+
+class CompareIf(Rule):
+    # eq|lt|gt / if-goto
+    name = "compare-if"
+
+    def match(self, commands, i):
+        window = commands[i:i + 2]
+        if (len(window) == 2 and isArithmetic(window[0], JUMPS) and
+                window[1][2] == "C_IF"):
+            return 2
+        return 0
+
+    def lines(self, writer, commands):
+        return compareJump(writer, commands[-1][3], JUMPS[commands[0][3]])
+
+
+def compareJump(writer, target, jump):
+    # x - y is computed as the inline comparisons do, so overflow behaves
+    # the same.
+    lines = list()
+    popD(lines)
+    lines.append("@SP")
+    lines.append("AM=M-1")
+    lines.append("D=M-D")
+    lines.append("@" + label(writer, target))
+    lines.append("D;" + jump)
+    return lines
+
+
+class NotIf(Rule):
+    # not / if-goto: jumps unless the value is -1.
+    name = "not-if"
+
+    def match(self, commands, i):
+        window = commands[i:i + 2]
+        if (len(window) == 2 and isArithmetic(window[0], ["not"]) and
+                window[1][2] == "C_IF"):
+            return 2
+        return 0
+
+    def lines(self, writer, commands):
+        lines = list()
+        lines.append("@SP")
+        lines.append("AM=M-1")
+        lines.append("D=M+1")
+        lines.append("@" + label(writer, commands[1][3]))
+        lines.append("D;JNE")
+        return lines
+
+
+class Move(Rule):
+    # push x / pop y, without touching the stack.
+    name = "move"
+
+    def match(self, commands, i):
+        window = commands[i:i + 2]
+        if (len(window) == 2 and isPush(window[0]) and isPop(window[1])):
+            return 2
+        return 0
+
+    def lines(self, writer, commands):
+        source, target = commands
+        lines = list()
+        if (source[3] == "constant" and source[4] in LITERALS and
+                select(writer, lines, target[3], target[4])):
+            lines.append("M=" + LITERALS[source[4]])
+            return lines
+        value = list()
+        load(writer, value, source[3], source[4])
+        store(writer, lines, target[3], target[4], value)
+        return lines
+
+
+class ConstantOperation(Rule):
+    # push constant c / add|sub|and|or, on the top of the stack in place.
+    name = "constant-op"
+
+    def match(self, commands, i):
+        window = commands[i:i + 2]
+        if (len(window) == 2 and isPush(window[0], "constant") and
+                isArithmetic(window[1], CONSTANT_OPERATORS)):
+            return 2
+        return 0
+
+    def lines(self, writer, commands):
+        constant, operator = commands
+        operator = operator[3]
+        if (constant[4] == "1" and operator in ["add", "sub"]):
+            return ["@SP", "A=M-1",
+                    "M=M+1" if operator == "add" else "M=M-1"]
+        return ["@" + constant[4], "D=A", "@SP", "A=M-1",
+                "M=" + OPERATORS[operator]]
+
+
+class Push(Rule):
+    name = "push"
+
+    def match(self, commands, i):
+        return 1 if isPush(commands[i]) else 0
+
+    def lines(self, writer, commands):
+        segment, index = commands[0][3:]
+        lines = list()
+        if (segment == "constant" and index in LITERALS):
+            lines.append("@SP")
+            lines.append("AM=M+1")
+            lines.append("A=A-1")
+            lines.append("M=" + LITERALS[index])
+            return lines
+        load(writer, lines, segment, index)
+        pushD(lines)
+        return lines
+
+
+class Pop(Rule):
+    name = "pop"
+
+    def match(self, commands, i):
+        return 1 if isPop(commands[i]) else 0
+
+    def lines(self, writer, commands):
+        segment, index = commands[0][3:]
+        lines = list()
+        value = list()
+        popD(value)
+        store(writer, lines, segment, index, value)
+        return lines
+
+
+class If(Rule):
+    name = "if"
+
+    def match(self, commands, i):
+        return 1 if commands[i][2] == "C_IF" else 0
+
+    def lines(self, writer, commands):
+        lines = list()
+        popD(lines)
+        lines.append("@" + label(writer, commands[0][3]))
+        lines.append("D;JNE")
+        return lines
+
+
+# Tried in order at each command, so longer patterns come first.
+RULES = [Update(), CompareNotIf(), CompareIf(), NotIf(), Move(),
+         ConstantOperation(), Push(), Pop(), If()]
+
+
+def optimize(commands, rules=RULES):
+    optimized = list()
+    i = 0
+    while (i < len(commands)):
+        for rule in rules:
+            count = rule.match(commands, i)
+            if (count):
+                matched = commands[i:i + count]
+                text = "{} [{}]".format(
+                    " / ".join(c[1] for c in matched), rule.name)
+                optimized.append((matched[0][0], text, "C_FUSED", rule,
+                                  matched))
+                i += count
+                break
+        else:
+            optimized.append(commands[i])
+            i += 1
+    return optimized
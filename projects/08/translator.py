@@ -1,11 +1,33 @@
+import argparse
 import sys
 from pathlib import Path
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import instrument  # noqa: E402
+from peephole import RULES, optimize  # noqa: E402
+
+trace = instrument.Tracer("translator")
+
+# Labels of the shared runtime routines, which VM names cannot clash with.
+CALL_ROUTINE = "$CALL"
+RETURN_ROUTINE = "$RETURN"
+COMPARE_ROUTINES = {"JEQ": "$EQ", "JLT": "$LT", "JGT": "$GT"}
+TRUE_ROUTINE = "$TRUE"
+HALT_LABEL = "$HALT"
+
 
 class CodeWriter:
-    def __init__(self, filename):
+    def __init__(self, filename, sourceMap=False, sharedCalls=False,
+                 sharedCompare=False, peephole=False):
         self.output = open(filename, "w")
         self.label_count = 0
+        self.source_map = sourceMap
+        self.shared_calls = sharedCalls
+        self.shared_compare = sharedCompare
+        self.rules = RULES if peephole else []
+        # The comparison routines called so far, written at the end.
+        self.comparisons = set()
+        self.current_file = "bootstrap"
         self.writeInit()
         self.function_name_stack = ["null"]
 
@@ -15,18 +37,35 @@ class CodeWriter:
     def getCurrentFilePrefix(self):
         return self.current_file.split(".")[0]
 
+    def writeSource(self, line, command, functionName=None):
+        # Source map marker for the assembler: every instruction up to the
+        # next marker was translated from this VM command.
+        if (not self.source_map):
+            return
+        if (functionName is None):
+            functionName = self.function_name_stack[-1]
+        self.writeToOutput(["//@ {}:{} {} {}".format(
+            self.current_file, line, functionName, command)])
+
     def writeInit(self):
-        print("Writing init TODO")
+        trace.debug("Writing init")
+        self.writeSource(0, "init", "(bootstrap)")
         lines = list()
         lines.append("@256")
         lines.append("D=A")
         lines.append("@SP")
         lines.append("M=D")
         self.writeToOutput(lines)
+        self.writeSource(0, "call Sys.init 0", "(bootstrap)")
         self.writeCall("Sys.init", "0")
+        # Sys.init never returns, so runtime routines can follow the
+        # bootstrap without being jumped over.
+        if (self.shared_calls):
+            self.writeCallRoutine()
+            self.writeReturnRoutine()
 
     def writeLabel(self, label, shouldPrefix=False):
-        print("Writing label: " + label)
+        trace.debug("Writing label: {}", label)
         lines = list()
         if(shouldPrefix):
             label = "{}${}".format(self.function_name_stack[-1], label)
@@ -34,7 +73,7 @@ class CodeWriter:
         self.writeToOutput(lines)
 
     def writeGoto(self, label, shouldPrefix=False):
-        print("Writing goto: " + label)
+        trace.debug("Writing goto: {}", label)
         lines = list()
         if(shouldPrefix):
             label = "{}${}".format(self.function_name_stack[-1], label)
@@ -43,7 +82,7 @@ class CodeWriter:
         self.writeToOutput(lines)
 
     def writeIf(self, label, shouldPrefix=False):
-        print("Writing if: " + label)
+        trace.debug("Writing if: {}", label)
         lines = list()
         if(shouldPrefix):
             label = "{}${}".format(self.function_name_stack[-1], label)
@@ -54,9 +93,27 @@ class CodeWriter:
         self.writeToOutput(lines)
 
     def writeCall(self, functionName, numArgs):
-        print("Writing call: " + functionName + " " + numArgs)
+        trace.debug("Writing call: {} {}", functionName, numArgs)
         lines = list()
         return_label = self.uniqueLabel("RETURN")
+        if (self.shared_calls):
+            # The call routine takes the return address in R14, the number
+            # of arguments in R15 and the function in D.
+            lines.append("@{}".format(return_label))
+            lines.append("D=A")
+            lines.append("@R14")
+            lines.append("M=D")
+            lines.append("@{}".format(numArgs))
+            lines.append("D=A")
+            lines.append("@R15")
+            lines.append("M=D")
+            lines.append("@{}".format(functionName))
+            lines.append("D=A")
+            lines.append("@{}".format(CALL_ROUTINE))
+            lines.append("0;JMP")
+            self.writeToOutput(lines)
+            self.writeLabel(return_label)
+            return
         lines.append("@{}".format(return_label))
         lines.append("D=A")
         lines.append("@SP")
@@ -87,8 +144,51 @@ class CodeWriter:
         self.writeGoto(functionName)
         self.writeLabel(return_label)
 
+    def writeCallRoutine(self):
+        # Pushes the frame of a call made by a shared-call site, then sets
+        # ARG and LCL and jumps to the function.
+        self.writeSource(0, "call", "(runtime)")
+        lines = list()
+        lines.append("(" + CALL_ROUTINE + ")")
+        lines.append("@R13")
+        lines.append("M=D")
+        lines.append("@R14")
+        lines.append("D=M")
+        self.pushD(lines)
+        for pointer in ["LCL", "ARG", "THIS", "THAT"]:
+            lines.append("@" + pointer)
+            lines.append("D=M")
+            self.pushD(lines)
+        lines.append("@R15")
+        lines.append("D=M")
+        lines.append("@5")
+        lines.append("D=D+A")
+        lines.append("@SP")
+        lines.append("D=M-D")
+        lines.append("@ARG")
+        lines.append("M=D")
+        lines.append("@SP")
+        lines.append("D=M")
+        lines.append("@LCL")
+        lines.append("M=D")
+        lines.append("@R13")
+        lines.append("A=M")
+        lines.append("0;JMP")
+        self.writeToOutput(lines)
+
+    def writeReturnRoutine(self):
+        self.writeSource(0, "return", "(runtime)")
+        self.writeLabel(RETURN_ROUTINE)
+        self.writeToOutput(self.returnLines())
+
     def writeReturn(self):
-        print("Writing return")
+        trace.debug("Writing return")
+        if (self.shared_calls):
+            self.writeGoto(RETURN_ROUTINE)
+        else:
+            self.writeToOutput(self.returnLines())
+
+    def returnLines(self):
         lines = list()
         lines.append("@LCL")
         lines.append("D=M")
@@ -140,18 +240,17 @@ class CodeWriter:
         lines.append("@RET")
         lines.append("A=M")
         lines.append("0;JMP")
-
-        self.writeToOutput(lines)
+        return lines
 
     def writeFunction(self, functionName, numLocals):
-        print("Writing function: " + functionName + " " + numLocals)
+        trace.debug("Writing function: {} {}", functionName, numLocals)
         self.writeLabel(functionName)
         self.function_name_stack.append(functionName)
         for i in range(int(numLocals)):
             self.writePushPop("C_PUSH", "constant", "0")
 
     def writeArithmetic(self, command):
-        print("Writing arthmetic: " + command)
+        trace.debug("Writing arthmetic: {}", command)
         lines = list()
         if (command == "add"):
             self.twoArgs(lines)
@@ -178,35 +277,50 @@ class CodeWriter:
             lines.append("M=-M")
             self.advanceStack(lines)
         elif (command == "eq"):
-            self.twoArgs(lines)
             self.writeComp(lines, "JEQ")
-            self.advanceStack(lines)
         elif (command == "lt"):
-            self.twoArgs(lines)
             self.writeComp(lines, "JLT")
-            self.advanceStack(lines)
         elif (command == "gt"):
-            self.twoArgs(lines)
             self.writeComp(lines, "JGT")
-            self.advanceStack(lines)
 
         self.writeToOutput(lines)
 
+    def writeFused(self, rule, commands):
+        trace.debug("Writing {}: {} commands", rule.name, len(commands))
+        self.writeToOutput(rule.lines(self, commands))
+
     def writeToOutput(self, lines):
         out = "\n".join(lines) + "\n"
-        # print(out)
+        trace.count("asm lines", len(lines))
         self.output.write(out)
 
     def advanceStack(self, lines):
         lines.append("@SP")
         lines.append("M=M+1")
 
+    def pushD(self, lines):
+        lines.append("@SP")
+        lines.append("AM=M+1")
+        lines.append("A=A-1")
+        lines.append("M=D")
+
     def uniqueLabel(self, label):
         suffix = self.label_count
         self.label_count += 1
         return label + str(suffix)
 
     def writeComp(self, lines, jump):
+        if (self.shared_compare):
+            # The comparison routines take the return address in D.
+            self.comparisons.add(jump)
+            return_label = self.uniqueLabel("COMPARED")
+            lines.append("@" + return_label)
+            lines.append("D=A")
+            lines.append("@" + COMPARE_ROUTINES[jump])
+            lines.append("0;JMP")
+            lines.append("(" + return_label + ")")
+            return
+        self.twoArgs(lines)
         truelabel = self.uniqueLabel("TRUELABEL")
         finishlabel = self.uniqueLabel("FINISHLABEL")
         lines.append("@SP")
@@ -225,6 +339,50 @@ class CodeWriter:
         lines.append("@SP")
         lines.append("A=M")
         lines.append("M=D")
+        self.advanceStack(lines)
+
+    def writeCompareRoutines(self):
+        # Each routine replaces the top two stack values x, y with x-y
+        # compared to 0, then jumps back to the address saved in R14. The
+        # true case is shared. Only the routines used are written.
+        if (not self.comparisons):
+            return
+        self.current_file = "runtime"
+        # VM code without functions runs off its last command, so it is
+        # stopped before it reaches the routines.
+        self.writeSource(0, "halt", "(runtime)")
+        self.writeLabel(HALT_LABEL)
+        self.writeGoto(HALT_LABEL)
+        lines = list()
+        for jump in sorted(self.comparisons):
+            routine = COMPARE_ROUTINES[jump]
+            self.writeSource(0, routine[1:].lower(), "(runtime)")
+            lines.append("(" + routine + ")")
+            lines.append("@R14")
+            lines.append("M=D")
+            lines.append("@SP")
+            lines.append("AM=M-1")
+            lines.append("D=M")
+            lines.append("A=A-1")
+            lines.append("D=M-D")
+            lines.append("@" + TRUE_ROUTINE)
+            lines.append("D;" + jump)
+            lines.append("@SP")
+            lines.append("A=M-1")
+            lines.append("M=0")
+            lines.append("@R14")
+            lines.append("A=M")
+            lines.append("0;JMP")
+            self.writeToOutput(lines)
+            lines = list()
+        lines.append("(" + TRUE_ROUTINE + ")")
+        lines.append("@SP")
+        lines.append("A=M-1")
+        lines.append("M=-1")
+        lines.append("@R14")
+        lines.append("A=M")
+        lines.append("0;JMP")
+        self.writeToOutput(lines)
 
     def oneArg(self, lines):
         lines.append("@SP")
@@ -241,7 +399,7 @@ class CodeWriter:
         lines.append("A=M")
 
     def writePushPop(self, command, segment, index):
-        print("Writing push/pop: " + command + " " + segment + " " + index)
+        trace.debug("Writing push/pop: {} {} {}", command, segment, index)
         lines = list()
         if (command == "C_PUSH"):
             if (segment == "constant"):
@@ -330,6 +488,7 @@ class CodeWriter:
         lines.append("M=D")
 
     def close(self):
+        self.writeCompareRoutines()
         self.output.close()
 
 
@@ -356,8 +515,12 @@ class Parser:
     def advance(self):
         l = self.lines[self.current_index].strip()
         l = self.stripComments(l)
+        self.text = l.strip()
         parts = l.split(" ")
         cmd = parts[0]
+        # Not every command has arguments; none carry over from the last.
+        self.arg1 = None
+        self.arg2 = None
         if (cmd == "push"):
             self.command = "C_PUSH"
             self.arg1 = parts[1]
@@ -399,42 +562,89 @@ class Parser:
         self.file.close()
 
 
+def readCommands(parser):
+    # (line, text, command, arg1, arg2) for each command of a file.
+    commands = list()
+    while (parser.hasMoreCommands()):
+        parser.advance()
+        commands.append((parser.current_index + 1, parser.text,
+                         parser.command, parser.arg1, parser.arg2))
+    return commands
+
+
+def translate(files, codewriter):
+    for p in files:
+        trace.info("Handling " + p.name)
+        trace.count("files")
+        with trace.phase("read"):
+            parser = Parser(p)
+            commands = readCommands(parser)
+            parser.close()
+        trace.count("lines", len(parser.lines))
+        codewriter.setFileName(p.name)
+        if (codewriter.rules):
+            with trace.phase("optimize"):
+                commands = optimize(commands, codewriter.rules)
+        with trace.phase("translate"):
+            for line, text, cmd, arg1, arg2 in commands:
+                trace.count("commands")
+                codewriter.writeSource(
+                    line, text, arg1 if cmd == "C_FUNCTION" else None)
+                if (cmd == "C_PUSH" or cmd == "C_POP"):
+                    codewriter.writePushPop(cmd, arg1, arg2)
+                elif (cmd == "C_ARITHMETIC"):
+                    codewriter.writeArithmetic(arg1)
+                elif (cmd == "C_LABEL"):
+                    codewriter.writeLabel(arg1, True)
+                elif (cmd == "C_GOTO"):
+                    codewriter.writeGoto(arg1, True)
+                elif (cmd == "C_IF"):
+                    codewriter.writeIf(arg1, True)
+                elif (cmd == "C_CALL"):
+                    codewriter.writeCall(arg1, arg2)
+                elif (cmd == "C_FUNCTION"):
+                    codewriter.writeFunction(arg1, arg2)
+                elif (cmd == "C_RETURN"):
+                    codewriter.writeReturn()
+                elif (cmd == "C_FUSED"):
+                    trace.count("fused " + arg1.name)
+                    codewriter.writeFused(arg1, arg2)
+
+
 if (__name__ == "__main__"):
+    args = argparse.ArgumentParser()
+    args.add_argument("input")
+    args.add_argument("--source-map", action="store_true",
+                      help="mark the VM command behind each block of asm")
+    args.add_argument("--shared-calls", action="store_true",
+                      help="call and return through one shared routine "
+                           "each instead of inlining them")
+    args.add_argument("--shared-compare", action="store_true",
+                      help="compute eq, lt and gt in shared routines")
+    args.add_argument("--peephole", action="store_true",
+                      help="translate common command sequences as one")
+    instrument.addArguments(args)
+    args = args.parse_args()
+    instrument.configure(trace, args)
+
     files = list()
-    input_file = Path(sys.argv[1])
+    input_file = Path(args.input)
     if (input_file.is_dir()):
         for child in input_file.iterdir():
             if (child.name.endswith(".vm")):
                 files.append(child)
         codewriter = CodeWriter(
-            "{}/{}.asm".format(input_file.name, input_file.name))
+            "{}/{}.asm".format(input_file.name, input_file.name),
+            args.source_map, args.shared_calls, args.shared_compare,
+            args.peephole)
     elif (input_file.is_file()):
         files.append(input_file)
         codewriter = CodeWriter("{}.asm"
-                                .format(input_file.name.replace(".vm", "")))
+                                .format(input_file.name.replace(".vm", "")),
+                                args.source_map, args.shared_calls,
+                                args.shared_compare, args.peephole)
 
-    for p in files:
-        print("Handling " + p.name)
-        parser = Parser(p)
-        codewriter.setFileName(p.name)
-        while (parser.hasMoreCommands()):
-            parser.advance()
-            cmd = parser.command
-            if (cmd == "C_PUSH" or cmd == "C_POP"):
-                codewriter.writePushPop(cmd, parser.arg1, parser.arg2)
-            elif (cmd == "C_ARITHMETIC"):
-                codewriter.writeArithmetic(parser.arg1)
-            elif (cmd == "C_LABEL"):
-                codewriter.writeLabel(parser.arg1, True)
-            elif (cmd == "C_GOTO"):
-                codewriter.writeGoto(parser.arg1, True)
-            elif (cmd == "C_IF"):
-                codewriter.writeIf(parser.arg1, True)
-            elif (cmd == "C_CALL"):
-                codewriter.writeCall(parser.arg1, parser.arg2)
-            elif (cmd == "C_FUNCTION"):
-                codewriter.writeFunction(parser.arg1, parser.arg2)
-            elif (cmd == "C_RETURN"):
-                codewriter.writeReturn()
-        parser.close()
+    translate(files, codewriter)
     codewriter.close()
+    trace.count("labels", codewriter.label_count)
+    instrument.finish(trace, args)
@@ -1,9 +1,15 @@
+import argparse
 import sys
 import re
 from pathlib import Path
 from SymbolTable import SymbolTable
 from vmwriter import VMWriter
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import instrument  # noqa: E402
+
+trace = instrument.Tracer("compiler")
+
 IDENTIFIER = '^(\w+)'
 SYMBOL = '^(\W)'
 INTEGER = '^(\d+)'
@@ -135,6 +141,7 @@ class CompileEngine:
     def advance(self):
         if (self.tokenizer.hasMoreTokens()):
             self.tokenizer.advance()
+            trace.count("tokens")
 
     def uniqueLabel(self, label):
         self.label_count += 1
@@ -461,7 +468,7 @@ class CompileEngine:
                 elif (value in ["FALSE", "NULL"]):
                     self.writer.writePush("CONST", 0)
                 else:
-                    print(value)
+                    trace.error("unexpected keyword constant: {}", value)
                     raise Exception()
             else:
                 self.writer.writePush(sym.kind, sym.index)
@@ -482,8 +489,14 @@ class CompileEngine:
 
 # JackAnalyzer
 if (__name__ == "__main__"):
+    args = argparse.ArgumentParser()
+    args.add_argument("input")
+    instrument.addArguments(args)
+    args = args.parse_args()
+    instrument.configure(trace, args)
+
     files = list()
-    input_file = Path(sys.argv[1])
+    input_file = Path(args.input)
     dir = "."
     if (input_file.is_dir()):
         dir = input_file.name
@@ -494,12 +507,19 @@ if (__name__ == "__main__"):
         files.append(input_file)
 
     for p in files:
-        print("Handling " + p.name)
-        tokenizer = JackTokenizer(p)
+        trace.info("Handling " + p.name)
+        trace.count("files")
+        with trace.phase("read"):
+            tokenizer = JackTokenizer(p)
         symbolTable = SymbolTable()
         compileEngine = CompileEngine(symbolTable, tokenizer,
                                       "{}/{}.vm".format(dir,
                                                         p.name.split(".")[0]))
         # tokenizer.writeTokenXml()
-        compileEngine.compileClass()
-        compileEngine.writeFile()
+        with trace.phase("compile"):
+            compileEngine.compileClass()
+        trace.count("vm lines", len(compileEngine.writer.lines))
+        trace.count("labels", compileEngine.label_count)
+        with trace.phase("write"):
+            compileEngine.writeFile()
+    instrument.finish(trace, args)
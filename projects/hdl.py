@@ -0,0 +1,1002 @@
+import argparse
+import hashlib
+import marshal
+import os
+import pickle
+import random
+import re
+import sys
+from pathlib import Path
+
+import instrument
+
+trace = instrument.Tracer("hdl")
+
+PROJECTS = Path(__file__).resolve().parent
+# Directories searched for the .hdl of a part, after the chip's own.
+SEARCH = ["01", "02", "03/a", "03/b", "05"]
+
+TOKEN = re.compile(r"\.\.|\w+|[{}()\[\],;:=]")
+COMMENT = re.compile(r"//[^\n]*|/\*.*?\*/", re.S)
+
+FALSE = 0
+TRUE = 1
+
+# Pins of the chips that have no .hdl of their own. Nand and DFF are the
+# gate-level primitives; the memories and the keyboard are always
+# simulated behaviorally, as in the course's hardware simulator.
+PRIMITIVES = {
+    "Nand": ([("a", 1), ("b", 1)], [("out", 1)]),
+    "DFF": ([("in", 1)], [("out", 1)]),
+    "ROM32K": ([("address", 15)], [("out", 16)]),
+    "Screen": ([("in", 16), ("load", 1), ("address", 13)], [("out", 16)]),
+    "Keyboard": ([], [("out", 16)]),
+}
+# Built-in variants of user chips, which only differ in their GUI.
+ALIASES = {"ARegister": "Register", "DRegister": "Register"}
+CACHE_VERSION = 1
+# Compiled code is cached as marshal data, which only the Python version
+# that wrote it can read.
+CACHE_PYTHON = sys.implementation.cache_tag
+
+
+class HdlError(Exception):
+    pass
+
+
+class ChipDef:
+    def __init__(self, name, inputs, outputs, parts, filename=None):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        # (part name, [(pin, pin bits, signal, signal bits)]), where bits
+        # is None for a whole bus or an inclusive (low, high) slice.
+        self.parts = parts
+        self.filename = filename
+
+
+class Tokens:
+    def __init__(self, text, filename):
+        self.tokens = TOKEN.findall(COMMENT.sub(" ", text))
+        self.filename = filename
+        self.i = 0
+
+    def peek(self):
+        return self.tokens[self.i] if self.i < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if (token is None):
+            raise HdlError("{}: unexpected end of file".format(self.filename))
+        self.i += 1
+        return token
+
+    def expect(self, expected):
+        token = self.next()
+        if (token != expected):
+            raise HdlError("{}: expected {!r}, got {!r}".format(
+                self.filename, expected, token))
+
+
+def parseHdl(text, filename=None):
+    tokens = Tokens(text, filename)
+    tokens.expect("CHIP")
+    name = tokens.next()
+    tokens.expect("{")
+    inputs = list()
+    outputs = list()
+    parts = list()
+    while (tokens.peek() in ["IN", "OUT"]):
+        pins = inputs if tokens.next() == "IN" else outputs
+        pins.extend(parsePins(tokens))
+    if (tokens.peek() == "BUILTIN"):
+        raise HdlError("{}: {} is a built-in chip".format(filename, name))
+    tokens.expect("PARTS")
+    tokens.expect(":")
+    while (tokens.peek() != "}"):
+        parts.append(parsePart(tokens))
+    tokens.expect("}")
+    return ChipDef(name, inputs, outputs, parts, filename)
+
+
+def parsePins(tokens):
+    pins = list()
+    while (True):
+        name = tokens.next()
+        width = 1
+        if (tokens.peek() == "["):
+            tokens.next()
+            width = int(tokens.next())
+            tokens.expect("]")
+        pins.append((name, width))
+        if (tokens.next() == ";"):
+            return pins
+
+
+def parsePart(tokens):
+    name = tokens.next()
+    tokens.expect("(")
+    connections = list()
+    while (True):
+        pin, pinBits = parseReference(tokens)
+        tokens.expect("=")
+        signal, signalBits = parseReference(tokens)
+        connections.append((pin, pinBits, signal, signalBits))
+        if (tokens.next() == ")"):
+            break
+    tokens.expect(";")
+    return (name, connections)
+
+
+def parseReference(tokens):
+    name = tokens.next()
+    if (tokens.peek() != "["):
+        return name, None
+    tokens.next()
+    low = high = int(tokens.next())
+    if (tokens.peek() == ".."):
+        tokens.next()
+        high = int(tokens.next())
+    tokens.expect("]")
+    return name, (low, high)
+
+
+class Library:
+    # Finds and parses the .hdl of each chip once.
+    def __init__(self, directories=None):
+        if (directories is None):
+            directories = [PROJECTS / d for d in SEARCH]
+        self.directories = [Path(d) for d in directories]
+        self.chips = dict()
+        # The hash of each .hdl read, by filename.
+        self.digests = dict()
+
+    def find(self, name):
+        for directory in self.directories:
+            path = directory / (name + ".hdl")
+            if (path.exists()):
+                return path
+        raise HdlError("cannot find {}.hdl".format(name))
+
+    def chip(self, name):
+        name = ALIASES.get(name, name)
+        if (name not in self.chips):
+            path = self.find(name)
+            with open(path, "r") as file:
+                text = file.read()
+            self.chips[name] = parseHdl(text, str(path))
+            self.digests[str(path)] = digest(text)
+            trace.count("chips parsed")
+        return self.chips[name]
+
+    def interface(self, name):
+        if (name in PRIMITIVES):
+            return PRIMITIVES[name]
+        chip = self.chip(name)
+        return chip.inputs, chip.outputs
+
+    def fresh(self, sources):
+        # Whether each .hdl in sources is still the one found for its chip
+        # and still has the given hash.
+        for filename, expected in sources.items():
+            path = Path(filename)
+            try:
+                if (self.find(path.stem) != path):
+                    return False
+                with open(path, "r") as file:
+                    if (digest(file.read()) != expected):
+                        return False
+            except (OSError, HdlError):
+                return False
+        return True
+
+
+def digest(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class Model:
+    # A chip simulated behaviorally instead of from gates. depends lists the
+    # input pins its outputs follow combinationally; a model without any is
+    # sequential, and its outputs only change on tock.
+    depends = ()
+
+    def __init__(self, name, pins, outputs):
+        self.name = name
+        self.pins = pins
+        self.outputs = outputs
+        self.inputs = [pin for pin in pins if pin not in outputs]
+
+    def resolve(self, number):
+        self.pins = {pin: [number[n] for n in nets]
+                     for pin, nets in self.pins.items()}
+
+    def reads(self):
+        return [n for pin in self.depends for n in self.pins.get(pin, [])]
+
+    def writes(self):
+        return [n for pin in self.outputs for n in self.pins[pin]]
+
+    def read(self, values):
+        return {pin: bitsValue(values, self.pins[pin])
+                for pin in self.inputs}
+
+    def bits(self, values):
+        # (net, bit) for every output net, from the current inputs.
+        outputs = self.output(self.read(values))
+        return [(net, outputs[pin] >> bit & 1) for pin in self.outputs
+                for bit, net in enumerate(self.pins[pin])]
+
+    def update(self, values):
+        for net, bit in self.bits(values):
+            values[net] = bit
+
+    def tick(self, values):
+        pass
+
+    def tock(self):
+        pass
+
+    def peek(self, index=None):
+        raise HdlError("{} has no state".format(self.name))
+
+    def poke(self, index, value):
+        raise HdlError("{} has no state".format(self.name))
+
+
+class Memory(Model):
+    # Word-addressed memory. Reads are combinational, writes are sampled on
+    # tick and become visible on tock, like a DFF.
+    depends = ("address",)
+
+    def __init__(self, name, pins, outputs):
+        Model.__init__(self, name, pins, outputs)
+        self.words = [0] * (1 << len(pins.get("address", [])))
+        self.pending = None
+
+    def output(self, inputs):
+        return {"out": self.words[inputs.get("address", 0)]}
+
+    def tick(self, values):
+        self.pending = None
+        if ("load" in self.pins and values[self.pins["load"][0]]):
+            self.pending = (bitsValue(values, self.pins["address"]),
+                            bitsValue(values, self.pins["in"]))
+
+    def tock(self):
+        if (self.pending is not None):
+            address, value = self.pending
+            self.words[address] = value
+
+    def peek(self, index=None):
+        return self.words[index or 0]
+
+    def poke(self, index, value):
+        self.words[index or 0] = value & 0xFFFF
+
+    def load(self, words):
+        self.words[:len(words)] = words
+
+
+class Register(Model):
+    # Bit, Register, ARegister and DRegister. peek() shows the value
+    # latched on tick, which the outputs only follow on tock.
+    def __init__(self, name, pins, outputs):
+        Model.__init__(self, name, pins, outputs)
+        self.value = 0
+        self.next = 0
+
+    def output(self, inputs):
+        return {"out": self.value}
+
+    def tick(self, values):
+        self.next = self.value
+        if (values[self.pins["load"][0]]):
+            self.next = bitsValue(values, self.pins["in"])
+
+    def tock(self):
+        self.value = self.next
+
+    def peek(self, index=None):
+        return self.next
+
+    def poke(self, index, value):
+        self.value = self.next = value & ((1 << len(self.pins["out"])) - 1)
+
+
+class Counter(Register):
+    def tick(self, values):
+        inputs = self.read(values)
+        if (inputs["reset"]):
+            self.next = 0
+        elif (inputs["load"]):
+            self.next = inputs["in"]
+        elif (inputs["inc"]):
+            self.next = (self.value + 1) & 0xFFFF
+        else:
+            self.next = self.value
+
+
+class Alu(Model):
+    depends = ("x", "y", "zx", "nx", "zy", "ny", "f", "no")
+
+    def output(self, p):
+        x = 0 if p["zx"] else p["x"]
+        x = x ^ 0xFFFF if p["nx"] else x
+        y = 0 if p["zy"] else p["y"]
+        y = y ^ 0xFFFF if p["ny"] else y
+        out = (x + y) & 0xFFFF if p["f"] else x & y
+        out = out ^ 0xFFFF if p["no"] else out
+        return {"out": out, "zr": int(out == 0), "ng": out >> 15}
+
+
+# Behavioral models that can stand in for the user's chips on request. The
+# primitive memories always use theirs.
+MODELS = {
+    "ROM32K": Memory,
+    "Screen": Memory,
+    "Keyboard": Memory,
+    "RAM8": Memory,
+    "RAM64": Memory,
+    "RAM512": Memory,
+    "RAM4K": Memory,
+    "RAM16K": Memory,
+    "Bit": Register,
+    "Register": Register,
+    "ARegister": Register,
+    "DRegister": Register,
+    "PC": Counter,
+    "ALU": Alu,
+}
+BUILTINS = ["ROM32K", "Screen", "Keyboard"]
+
+
+class Netlist:
+    # A chip flattened to single-bit nets, Nand gates, DFFs and behavioral
+    # models, which stand in for the chips named in builtins. Nets 0 and 1
+    # are the constants false and true.
+    def __init__(self, library, name, builtins=()):
+        self.library = library
+        self.name = name
+        self.builtins = set(BUILTINS) | set(builtins)
+        self.parent = [FALSE, TRUE]
+        self.nands = list()
+        self.dffs = list()
+        self.models = list()
+        # The output pins of the first instance of each chip in the
+        # hierarchy, which is how test scripts name built-in parts.
+        self.parts = dict()
+        # The hash of every .hdl the netlist was built from, by filename.
+        self.sources = dict()
+        # The code object of its compiled evaluation, once made.
+        self.code = None
+        chip = library.chip(name)
+        self.pins = {pin: self.newNets(width)
+                     for pin, width in chip.inputs + chip.outputs}
+        self.inputs = [pin for pin, _ in chip.inputs]
+        self.outputs = [pin for pin, _ in chip.outputs]
+        with trace.phase("flatten"):
+            self.signals = self.instantiate(name, dict(self.pins))
+            self.resolve()
+        with trace.phase("sort"):
+            self.order = self.sort()
+
+    def newNets(self, width):
+        start = len(self.parent)
+        self.parent.extend(range(start, start + width))
+        return list(range(start, start + width))
+
+    def find(self, net):
+        parent = self.parent
+        root = net
+        while (parent[root] != root):
+            root = parent[root]
+        while (parent[net] != root):
+            parent[net], net = root, parent[net]
+        return root
+
+    def union(self, driver, net):
+        driver = self.find(driver)
+        net = self.find(net)
+        if (driver == net):
+            return
+        if (net in [FALSE, TRUE]):
+            raise HdlError("a part output drives a constant")
+        self.parent[net] = driver
+
+    def instantiate(self, name, pins):
+        if (name in ["Nand", "DFF"]):
+            self.primitive(name, pins)
+            return pins
+        if (name in self.builtins):
+            outputs = [pin for pin, _ in self.library.interface(name)[1]]
+            self.models.append(MODELS[name](name, pins, outputs))
+            return pins
+        chip = self.library.chip(name)
+        self.sources[chip.filename] = self.library.digests[chip.filename]
+        signals = dict(pins)
+        outputs = set(pin for pin, _ in chip.outputs)
+        for part, connections in chip.parts:
+            partInputs, partOutputs = self.library.interface(part)
+            widths = dict(partInputs + partOutputs)
+            partPins = {pin: [FALSE] * width for pin, width in partInputs}
+            partPins.update({pin: self.newNets(width)
+                             for pin, width in partOutputs})
+            driven = set(pin for pin, _ in partOutputs)
+            for pin, pinBits, signal, signalBits in connections:
+                if (pin not in widths):
+                    raise HdlError("{}: {} has no pin {}".format(
+                        chip.filename, part, pin))
+                low, high = pinBits or (0, widths[pin] - 1)
+                width = high - low + 1
+                if (pin in driven):
+                    if (signal in ["true", "false"] or
+                            (signal in pins and signal not in outputs)):
+                        raise HdlError("{}: cannot drive {} from {}.{}"
+                                       .format(chip.filename, signal, part,
+                                               pin))
+                    nets = self.signal(signals, signal, signalBits, width,
+                                       chip)
+                    for bit, net in zip(partPins[pin][low:high + 1], nets):
+                        self.union(bit, net)
+                else:
+                    nets = self.signal(signals, signal, signalBits, width,
+                                       chip)
+                    partPins[pin][low:high + 1] = nets
+            self.parts.setdefault(part, partPins)
+            self.instantiate(part, partPins)
+        return signals
+
+    def signal(self, signals, signal, bits, width, chip):
+        if (signal in ["true", "false"]):
+            return [TRUE if signal == "true" else FALSE] * width
+        if (signal not in signals):
+            if (bits is not None):
+                raise HdlError("{}: sub-bus of internal pin {}".format(
+                    chip.filename, signal))
+            signals[signal] = self.newNets(width)
+        nets = signals[signal]
+        if (bits is not None):
+            nets = nets[bits[0]:bits[1] + 1]
+        if (len(nets) != width):
+            raise HdlError("{}: {} is {} bits wide, not {}".format(
+                chip.filename, signal, len(nets), width))
+        return nets
+
+    def primitive(self, name, pins):
+        if (name == "Nand"):
+            self.nands.append((pins["a"][0], pins["b"][0], pins["out"][0]))
+        else:
+            self.dffs.append((pins["in"][0], pins["out"][0]))
+
+    def resolve(self):
+        # Replaces every net by the root of its union, numbered densely.
+        find = self.find
+        roots = dict()
+        for net in range(len(self.parent)):
+            root = find(net)
+            if (root not in roots):
+                roots[root] = len(roots)
+        number = [roots[find(net)] for net in range(len(self.parent))]
+        self.size = len(roots)
+        self.nands = [(number[a], number[b], number[o])
+                      for a, b, o in self.nands]
+        self.dffs = [(number[i], number[o]) for i, o in self.dffs]
+        for model in self.models:
+            model.resolve(number)
+        self.pins = {p: [number[n] for n in nets]
+                     for p, nets in self.pins.items()}
+        self.signals = {s: [number[n] for n in nets]
+                        for s, nets in self.signals.items()}
+        self.parts = {c: {p: [number[n] for n in nets]
+                          for p, nets in pins.items()}
+                      for c, pins in self.parts.items()}
+        self.parent = None
+
+    def sort(self):
+        # Orders the combinational operations so each one runs after the
+        # operations driving its inputs. Operations are ("nand", index) and
+        # ("model", index); chip inputs and the outputs of DFFs and
+        # sequential models are sources.
+        operations = [("nand", i, (a, b), (o,))
+                      for i, (a, b, o) in enumerate(self.nands)]
+        operations += [("model", i, m.reads(), m.writes())
+                       for i, m in enumerate(self.models) if m.depends]
+        sources = [out for _, out in self.dffs]
+        sources += [n for m in self.models if not m.depends
+                    for n in m.writes()]
+        driver = dict()
+        for number, (_, _, _, outs) in enumerate(operations):
+            for net in outs:
+                if (net in driver or net in [FALSE, TRUE]):
+                    raise HdlError("{}: a net has more than one driver"
+                                   .format(self.name))
+                driver[net] = number
+        for out in sources:
+            if (out in driver):
+                raise HdlError("{}: a net has more than one driver"
+                               .format(self.name))
+        waiting = [0] * len(operations)
+        readers = [list() for _ in range(self.size)]
+        for number, (_, _, ins, _) in enumerate(operations):
+            for net in ins:
+                if (net in driver):
+                    waiting[number] += 1
+                    readers[net].append(number)
+        ready = [n for n in range(len(operations)) if waiting[n] == 0]
+        order = list()
+        while (ready):
+            number = ready.pop()
+            order.append(operations[number][:2])
+            for net in operations[number][3]:
+                for reader in readers[net]:
+                    waiting[reader] -= 1
+                    if (waiting[reader] == 0):
+                        ready.append(reader)
+        if (len(order) != len(operations)):
+            raise HdlError("{}: combinational loop".format(self.name))
+        return order
+
+    def save(self):
+        # The netlist as plain data, so a cache written while hdl.py runs
+        # as a script can be read when it is imported, and the other way
+        # around. Models are saved as their pins and rebuilt fresh.
+        state = dict(self.__dict__)
+        state["library"] = None
+        state["models"] = [(m.name, m.pins, m.outputs) for m in self.models]
+        if (self.code is not None):
+            state["code"] = marshal.dumps(self.code)
+        return state
+
+    @staticmethod
+    def restore(library, state):
+        netlist = Netlist.__new__(Netlist)
+        netlist.__dict__.update(state)
+        netlist.library = library
+        netlist.models = [MODELS[name](name, pins, outputs)
+                          for name, pins, outputs in state["models"]]
+        if (netlist.code is not None):
+            netlist.code = marshal.loads(netlist.code)
+        return netlist
+
+    def compile(self):
+        # Straight-line Python evaluating the combinational logic: one
+        # statement per Nand in topological order, so an evaluation has no
+        # dispatch or recursion. Runs with the models list as "models".
+        if (self.code is not None):
+            return self.code
+        lines = ["def evaluate(v):"]
+        for kind, i in self.order:
+            if (kind == "nand"):
+                a, b, o = self.nands[i]
+                lines.append("    v[{}] = 1 ^ (v[{}] & v[{}])".format(o, a, b))
+            elif (isinstance(self.models[i], Memory)):
+                # Memory reads are inlined, as they are most of the models.
+                model = self.models[i]
+                address = " | ".join(["v[{}] << {}".format(n, bit) for
+                                      bit, n in enumerate(model.reads())])
+                lines.append("    w = models[{}].words[{}]".format(
+                    i, address or "0"))
+                for bit, n in enumerate(model.pins["out"]):
+                    lines.append("    v[{}] = w >> {} & 1".format(n, bit))
+            else:
+                lines.append("    models[{}].update(v)".format(i))
+        lines.append("    return v")
+        self.code = compile("\n".join(lines), "<{}>".format(self.name),
+                            "exec")
+        return self.code
+
+
+def bitsValue(values, nets):
+    value = 0
+    for bit, net in enumerate(nets):
+        value |= values[net] << bit
+    return value
+
+
+class Chip:
+    # A netlist compiled into straight-line Python by Netlist.compile().
+    def __init__(self, netlist):
+        self.netlist = netlist
+        self.values = [0] * netlist.size
+        self.values[TRUE] = 1
+        self.state = [0] * len(netlist.dffs)
+        self.models = dict()
+        for model in netlist.models:
+            self.models.setdefault(model.name, model)
+        self.latched = {out: i for i, (_, out) in enumerate(netlist.dffs)}
+        with trace.phase("compile"):
+            self.evaluate = self.compile()
+        self.evaluate(self.values)
+
+    def compile(self):
+        netlist = self.netlist
+        namespace = {"models": netlist.models}
+        exec(netlist.compile(), namespace)
+        trace.count("nands", len(netlist.nands))
+        trace.count("dffs", len(netlist.dffs))
+        trace.count("models", len(netlist.models))
+        return namespace["evaluate"]
+
+    def set(self, pin, value):
+        values = self.values
+        for bit, net in enumerate(self.netlist.pins[pin]):
+            values[net] = value >> bit & 1
+
+    def get(self, pin):
+        if (pin in self.netlist.pins):
+            return bitsValue(self.values, self.netlist.pins[pin])
+        return bitsValue(self.values, self.netlist.signals[pin])
+
+    def eval(self):
+        self.evaluate(self.values)
+
+    def tick(self):
+        # DFFs and models sample their inputs; outputs hold.
+        values = self.values
+        self.evaluate(values)
+        self.state = [values[i] for i, _ in self.netlist.dffs]
+        for model in self.netlist.models:
+            model.tick(values)
+
+    def tock(self):
+        values = self.values
+        for (_, out), bit in zip(self.netlist.dffs, self.state):
+            values[out] = bit
+        for model in self.netlist.models:
+            model.tock()
+            if (not model.depends):
+                model.update(values)
+        self.evaluate(values)
+
+    def refresh(self, model):
+        # After a model's state was changed from outside.
+        if (not model.depends):
+            model.update(self.values)
+        self.evaluate(self.values)
+
+    def part(self, name, index=None):
+        # The stored value of a part, named as in test scripts: a model's
+        # state, or for a gate-level register the latched DFF state behind
+        # each output bit.
+        if (name in self.models):
+            return self.models[name].peek(index)
+        pins = self.netlist.parts.get(name)
+        if (pins is None):
+            raise HdlError("no part named " + name)
+        if (index is not None):
+            raise HdlError("{} is simulated from gates; its words can only "
+                           "be read from a built-in model".format(name))
+        value = 0
+        for bit, net in enumerate(pins["out"]):
+            if (net in self.latched):
+                value |= self.state[self.latched[net]] << bit
+            else:
+                value |= self.values[net] << bit
+        return value
+
+    def poke(self, name, index, value):
+        if (name not in self.models):
+            raise HdlError("{} is not a built-in model".format(name))
+        self.models[name].poke(index, value)
+        self.refresh(self.models[name])
+
+
+class EventChip(Chip):
+    # Event-driven evaluation: an operation is re-run only when one of its
+    # input nets changed. Operations are bucketed by logic level and the
+    # buckets run in order, so each runs at most once per evaluation. DFFs
+    # are only latched when their input changed, so a tick costs time in
+    # proportion to the activity in the circuit rather than its size.
+    def __init__(self, netlist):
+        self.netlist = netlist
+        self.values = [0] * netlist.size
+        self.values[TRUE] = 1
+        self.state = [0] * len(netlist.dffs)
+        self.models = dict()
+        for model in netlist.models:
+            self.models.setdefault(model.name, model)
+        self.latched = {out: i for i, (_, out) in enumerate(netlist.dffs)}
+        with trace.phase("compile"):
+            self.prepare()
+        self.watch = set(range(len(netlist.dffs)))
+        self.samples = list()
+        for rank in range(len(netlist.order)):
+            self.queue(rank)
+        self.eval()
+
+    def prepare(self):
+        # Operations are numbered by their position in the topological
+        # order; a model has -1 - its index as its first input.
+        netlist = self.netlist
+        self.first = first = list()
+        self.second = second = list()
+        self.result = result = list()
+        self.level = level = list()
+        self.readers = readers = [list() for _ in range(netlist.size)]
+        self.dffReaders = [list() for _ in range(netlist.size)]
+        self.modelRank = dict()
+        depth = [0] * netlist.size
+        for rank, (kind, i) in enumerate(netlist.order):
+            if (kind == "nand"):
+                a, b, o = netlist.nands[i]
+                ins = [a, b] if a != b else [a]
+                outs = [o]
+                first.append(a)
+                second.append(b)
+                result.append(o)
+            else:
+                ins = netlist.models[i].reads()
+                outs = netlist.models[i].writes()
+                first.append(-1 - i)
+                second.append(0)
+                result.append(0)
+                self.modelRank[netlist.models[i]] = rank
+            level.append(max([depth[n] for n in ins], default=0))
+            for net in ins:
+                readers[net].append(rank)
+            for net in outs:
+                depth[net] = level[rank] + 1
+        for i, (net, _) in enumerate(netlist.dffs):
+            self.dffReaders[net].append(i)
+        self.buckets = [list() for _ in range(max(level, default=0) + 1)]
+        self.queued = bytearray(len(netlist.order))
+
+    def queue(self, rank):
+        if (not self.queued[rank]):
+            self.queued[rank] = 1
+            self.buckets[self.level[rank]].append(rank)
+
+    def set(self, pin, value):
+        for bit, net in enumerate(self.netlist.pins[pin]):
+            self.change(net, value >> bit & 1)
+
+    def change(self, net, value):
+        if (self.values[net] == value):
+            return
+        self.values[net] = value
+        for rank in self.readers[net]:
+            self.queue(rank)
+        self.watch.update(self.dffReaders[net])
+
+    def eval(self):
+        queued = self.queued
+        first = self.first
+        second = self.second
+        result = self.result
+        level = self.level
+        buckets = self.buckets
+        readers = self.readers
+        dffReaders = self.dffReaders
+        watch = self.watch
+        values = self.values
+        evaluated = 0
+        for bucket in buckets:
+            if (not bucket):
+                continue
+            # Readers are always on a higher level, so the bucket does not
+            # grow while it runs.
+            for rank in bucket:
+                queued[rank] = 0
+                a = first[rank]
+                if (a < 0):
+                    self.publish(self.netlist.models[-1 - a])
+                    continue
+                out = 1 ^ (values[a] & values[second[rank]])
+                net = result[rank]
+                if (values[net] != out):
+                    values[net] = out
+                    for reader in readers[net]:
+                        if (not queued[reader]):
+                            queued[reader] = 1
+                            buckets[level[reader]].append(reader)
+                    if (dffReaders[net]):
+                        watch.update(dffReaders[net])
+            evaluated += len(bucket)
+            del bucket[:]
+        trace.count("evaluations", evaluated)
+
+    def publish(self, model):
+        for net, bit in model.bits(self.values):
+            self.change(net, bit)
+
+    def tick(self):
+        self.eval()
+        values = self.values
+        dffs = self.netlist.dffs
+        self.samples = list(self.watch)
+        for i in self.samples:
+            self.state[i] = values[dffs[i][0]]
+        self.watch = set()
+        for model in self.netlist.models:
+            model.tick(values)
+
+    def tock(self):
+        dffs = self.netlist.dffs
+        for i in self.samples:
+            self.change(dffs[i][1], self.state[i])
+        self.samples = list()
+        for model in self.netlist.models:
+            model.tock()
+            self.refresh(model, False)
+        self.eval()
+
+    def refresh(self, model, evaluate=True):
+        if (model.depends):
+            self.queue(self.modelRank[model])
+        else:
+            self.publish(model)
+        if (evaluate):
+            self.eval()
+
+
+def libraryFor(path):
+    return Library([Path(path).parent] + [PROJECTS / d for d in SEARCH])
+
+
+def loadCache(filename):
+    try:
+        with open(filename, "rb") as file:
+            cache = pickle.load(file)
+        if (cache.get("version") == CACHE_VERSION and
+                cache.get("python") == CACHE_PYTHON):
+            return cache
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+    return {"version": CACHE_VERSION, "python": CACHE_PYTHON,
+            "netlists": dict()}
+
+
+def saveCache(filename, cache):
+    # Test runners load chips from several processes at once, so the file
+    # is replaced whole rather than written in place.
+    temporary = "{}.{}".format(filename, os.getpid())
+    with open(temporary, "wb") as file:
+        pickle.dump(cache, file, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, filename)
+
+
+def cachedNetlist(library, name, builtins=(), cacheFile=None):
+    # Flattened and sorted netlists are pickled next to the chip's .hdl
+    # with their compiled code, one per set of built-in parts. An entry is
+    # used only while every .hdl it was built from is unchanged and still
+    # the one the library finds, so editing any part in the hierarchy
+    # rebuilds it. An entry that cannot be restored is rebuilt too.
+    if (cacheFile is None):
+        cacheFile = library.find(name).with_suffix(".hdlcache")
+    key = tuple(sorted(set(builtins)))
+    with trace.phase("cache"):
+        cache = loadCache(cacheFile)
+        entry = cache["netlists"].get(key)
+        if (entry is not None and library.fresh(entry["sources"])):
+            try:
+                netlist = Netlist.restore(library, entry["netlist"])
+                trace.count("cache hits")
+                return netlist
+            except (ValueError, EOFError, TypeError, KeyError):
+                trace.count("cache restore failures")
+    trace.count("cache misses")
+    netlist = Netlist(library, name, builtins)
+    with trace.phase("compile"):
+        netlist.compile()
+    with trace.phase("cache"):
+        cache["netlists"][key] = {"sources": netlist.sources,
+                                  "netlist": netlist.save()}
+        try:
+            saveCache(cacheFile, cache)
+        except OSError:
+            trace.count("cache write failures")
+    return netlist
+
+
+def load(filename, library=None, events=False, builtins=(), cache=False):
+    path = Path(filename)
+    if (library is None):
+        library = libraryFor(path)
+    if (cache):
+        netlist = cachedNetlist(library, path.stem, builtins,
+                                path.with_suffix(".hdlcache"))
+    else:
+        netlist = Netlist(library, path.stem, builtins)
+    return EventChip(netlist) if events else Chip(netlist)
+
+
+def randomInputs(chip, rand, addresses):
+    # Addresses come from a small pool so reads hit earlier writes.
+    values = dict()
+    for pin in chip.netlist.inputs:
+        width = len(chip.netlist.pins[pin])
+        if (pin == "address"):
+            values[pin] = rand.choice(addresses)
+        elif (pin == "reset"):
+            values[pin] = int(rand.random() < 0.1)
+        else:
+            values[pin] = rand.getrandbits(width)
+    return values
+
+
+def checkModel(library, name, cycles=1000, seed=0):
+    # Runs the behavioral model of a chip and its gate-level netlist on the
+    # same random inputs and returns the first differences found, as
+    # (cycle, phase, pin, model value, gate value).
+    model = Chip(Netlist(library, name, [name]))
+    gates = EventChip(Netlist(library, name))
+    rand = random.Random(seed)
+    width = len(gates.netlist.pins.get("address", []))
+    addresses = [rand.getrandbits(width) for _ in range(8)]
+    sequential = bool(gates.netlist.dffs or gates.netlist.models)
+    differences = list()
+    for cycle in range(cycles):
+        for pin, value in randomInputs(gates, rand, addresses).items():
+            model.set(pin, value)
+            gates.set(pin, value)
+        for phase in ["tick", "tock"] if sequential else ["eval"]:
+            getattr(model, phase)()
+            getattr(gates, phase)()
+            for pin in gates.netlist.outputs:
+                if (model.get(pin) != gates.get(pin)):
+                    differences.append((cycle, phase, pin, model.get(pin),
+                                        gates.get(pin)))
+        if (len(differences) >= 10):
+            break
+    trace.count("model cycles", cycle + 1)
+    return differences
+
+
+def parseAssignment(text):
+    pin, value = text.split("=")
+    return pin, int(value, 0)
+
+
+if (__name__ == "__main__"):
+    args = argparse.ArgumentParser()
+    args.add_argument("filename", help=".hdl file of the chip")
+    args.add_argument("--set", action="append", default=list(),
+                      metavar="PIN=VALUE", help="set an input pin")
+    args.add_argument("--ticks", type=int, default=0,
+                      help="clock cycles to run after setting the inputs")
+    args.add_argument("--events", action="store_true",
+                      help="only re-evaluate gates whose inputs changed")
+    args.add_argument("--builtin", action="append", default=list(),
+                      choices=sorted(MODELS), metavar="CHIP",
+                      help="simulate this part behaviorally")
+    args.add_argument("--check", action="store_true",
+                      help="cross-check each --builtin model against the "
+                           "gate-level chip instead of running")
+    args.add_argument("--cycles", type=int, default=1000,
+                      help="random cycles per --check")
+    args.add_argument("--no-cache", action="store_true",
+                      help="flatten the chip instead of reusing its "
+                           ".hdlcache")
+    instrument.addArguments(args)
+    args = args.parse_args()
+    instrument.configure(trace, args)
+
+    if (args.check):
+        library = libraryFor(args.filename)
+        failed = False
+        for name in args.builtin:
+            with trace.phase("check"):
+                differences = checkModel(library, name, args.cycles)
+            print("{:<4} {}".format("FAIL" if differences else "ok", name))
+            for cycle, phase, pin, model, gates in differences:
+                print("     cycle {} {}: {} = {} in the model, {} from gates"
+                      .format(cycle, phase, pin, model, gates))
+            failed = failed or bool(differences)
+        instrument.finish(trace, args)
+        sys.exit(1 if failed else 0)
+
+    chip = load(args.filename, events=args.events, builtins=args.builtin,
+                cache=not args.no_cache)
+    for text in args.set:
+        chip.set(*parseAssignment(text))
+    chip.eval()
+    with trace.phase("run"):
+        for _ in range(args.ticks):
+            chip.tick()
+            chip.tock()
+    trace.info("{} nets, {} nands, {} dffs", chip.netlist.size,
+               len(chip.netlist.nands), len(chip.netlist.dffs))
+    for pin in chip.netlist.outputs:
+        print("{} = {}".format(pin, chip.get(pin)))
+    instrument.finish(trace, args)
@@ -0,0 +1,241 @@
+import argparse
+import re
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from hdl import FALSE, TRUE, HdlError, load, trace
+import instrument
+
+OUTPUT_LIST = re.compile(r"output-list([^;]*);")
+OUTPUT = re.compile(r"^([^%]+)(?:%([BDXS])\d+\.\d+\.\d+)?$")
+EXHAUSTIVE_BITS = 24
+
+
+def mux(sel, *inputs):
+    return np.choose(sel.astype(np.intp), inputs)
+
+
+def dmux(value, sel, names):
+    return {name: np.where(sel == i, value, 0) for i, name in
+            enumerate(names)}
+
+
+def addition(a, b):
+    return (a + b) & 0xFFFF
+
+
+def alu(p):
+    x = np.where(p["zx"] != 0, 0, p["x"])
+    x = np.where(p["nx"] != 0, x ^ 0xFFFF, x)
+    y = np.where(p["zy"] != 0, 0, p["y"])
+    y = np.where(p["ny"] != 0, y ^ 0xFFFF, y)
+    out = np.where(p["f"] != 0, addition(x, y), x & y)
+    out = np.where(p["no"] != 0, out ^ 0xFFFF, out)
+    return {"out": out, "zr": (out == 0).astype(np.uint64),
+            "ng": (out >> 15).astype(np.uint64)}
+
+
+# Behavioral specifications of the combinational chips of projects 01 and
+# 02, on arrays of input values.
+MODELS = {
+    "Nand": lambda p: {"out": (p["a"] & p["b"]) ^ 1},
+    "Not": lambda p: {"out": p["in"] ^ 1},
+    "Not16": lambda p: {"out": p["in"] ^ 0xFFFF},
+    "And": lambda p: {"out": p["a"] & p["b"]},
+    "And16": lambda p: {"out": p["a"] & p["b"]},
+    "Or": lambda p: {"out": p["a"] | p["b"]},
+    "Or16": lambda p: {"out": p["a"] | p["b"]},
+    "Xor": lambda p: {"out": p["a"] ^ p["b"]},
+    "Or8Way": lambda p: {"out": (p["in"] != 0).astype(np.uint64)},
+    "Mux": lambda p: {"out": mux(p["sel"], p["a"], p["b"])},
+    "Mux16": lambda p: {"out": mux(p["sel"], p["a"], p["b"])},
+    "Mux4Way16": lambda p: {"out": mux(p["sel"],
+                                       *[p[c] for c in "abcd"])},
+    "Mux8Way16": lambda p: {"out": mux(p["sel"],
+                                       *[p[c] for c in "abcdefgh"])},
+    "DMux": lambda p: dmux(p["in"], p["sel"], "ab"),
+    "DMux4Way": lambda p: dmux(p["in"], p["sel"], "abcd"),
+    "DMux8Way": lambda p: dmux(p["in"], p["sel"], "abcdefgh"),
+    "HalfAdder": lambda p: {"sum": p["a"] ^ p["b"],
+                            "carry": p["a"] & p["b"]},
+    "FullAdder": lambda p: {"sum": (p["a"] + p["b"] + p["c"]) & 1,
+                            "carry": (p["a"] + p["b"] + p["c"]) >> 1},
+    "Add16": lambda p: {"out": addition(p["a"], p["b"])},
+    "Inc16": lambda p: {"out": addition(p["in"], 1)},
+    "ALU": alu,
+}
+
+
+class ParallelChip:
+    # Evaluates a combinational netlist on many input vectors at once.
+    # Every net holds one bit of each vector, packed into an array of
+    # uint64 words, so one Nand statement computes 64 vectors per word.
+    def __init__(self, netlist):
+        if (netlist.dffs or netlist.models):
+            raise HdlError(netlist.name + " is not combinational")
+        self.netlist = netlist
+        lines = ["def evaluate(v, M):"]
+        for _, i in netlist.order:
+            a, b, o = netlist.nands[i]
+            lines.append("    v[{}] = M ^ (v[{}] & v[{}])".format(o, a, b))
+        lines.append("    return v")
+        namespace = dict()
+        with trace.phase("compile"):
+            exec("\n".join(lines), namespace)
+        self.evaluate = namespace["evaluate"]
+
+    def widths(self):
+        return {pin: len(nets) for pin, nets in self.netlist.pins.items()}
+
+    def run(self, inputs):
+        # inputs maps each input pin to an array of values, one per vector.
+        count = len(next(iter(inputs.values())))
+        words = (count + 63) // 64
+        zeros = np.zeros(words, dtype=np.uint64)
+        values = [zeros] * self.netlist.size
+        values[TRUE] = ~zeros
+        values[FALSE] = zeros
+        for pin, vector in inputs.items():
+            vector = np.asarray(vector, dtype=np.uint64)
+            for bit, net in enumerate(self.netlist.pins[pin]):
+                values[net] = pack((vector >> np.uint64(bit)) & np.uint64(1),
+                                   words)
+        with trace.phase("evaluate"):
+            self.evaluate(values, ~zeros)
+        trace.count("vectors", count)
+        outputs = dict()
+        for pin in self.netlist.outputs:
+            out = np.zeros(count, dtype=np.uint64)
+            for bit, net in enumerate(self.netlist.pins[pin]):
+                out |= unpack(values[net], count) << np.uint64(bit)
+            outputs[pin] = out
+        return outputs
+
+
+def pack(bits, words):
+    packed = np.packbits(bits.astype(np.uint8), bitorder="little")
+    packed = np.pad(packed, (0, words * 8 - len(packed)))
+    return packed.view(np.uint64)
+
+
+def unpack(word, count):
+    bits = np.unpackbits(word.view(np.uint8), bitorder="little")
+    return bits[:count].astype(np.uint64)
+
+
+def exhaustiveInputs(chip):
+    # Every combination of the input bits, the lowest bits varying in the
+    # first input pin.
+    widths = chip.widths()
+    total = sum(widths[pin] for pin in chip.netlist.inputs)
+    vectors = np.arange(1 << total, dtype=np.uint64)
+    inputs = dict()
+    shift = 0
+    for pin in chip.netlist.inputs:
+        mask = np.uint64((1 << widths[pin]) - 1)
+        inputs[pin] = (vectors >> np.uint64(shift)) & mask
+        shift += widths[pin]
+    return inputs
+
+
+def randomInputs(chip, count, seed=0):
+    rand = np.random.default_rng(seed)
+    widths = chip.widths()
+    return {pin: rand.integers(0, 1 << widths[pin], count, dtype=np.uint64)
+            for pin in chip.netlist.inputs}
+
+
+def readCompare(tstFile, cmpFile, widths):
+    # The rows of a .cmp file as arrays of values per column, with a mask
+    # of the rows that are not '*' wildcards.
+    with open(tstFile, "r") as file:
+        formats = dict()
+        for entry in OUTPUT_LIST.search(file.read()).group(1).split():
+            match = OUTPUT.match(entry)
+            formats[match.group(1)] = match.group(2) or "D"
+    with open(cmpFile, "r") as file:
+        rows = [[c.strip() for c in line.strip().strip("|").split("|")]
+                for line in file if line.strip() != ""]
+    columns = dict()
+    for i, name in enumerate(rows[0]):
+        texts = [row[i] for row in rows[1:]]
+        mask = (1 << widths[name]) - 1
+        base = {"B": 2, "X": 16}.get(formats.get(name, "D"), 10)
+        known = np.array(["*" not in t for t in texts])
+        values = [int(t, base) & mask if "*" not in t else 0 for t in texts]
+        columns[name] = (np.array(values, dtype=np.uint64), known)
+    return columns
+
+
+def mismatches(outputs, expected, known=None):
+    # (pin, vector index, got, expected) for each differing vector.
+    errors = list()
+    for pin, values in expected.items():
+        wrong = outputs[pin] != values
+        if (known is not None):
+            wrong &= known[pin]
+        for i in np.flatnonzero(wrong)[:10]:
+            errors.append((pin, int(i), int(outputs[pin][i]),
+                           int(values[i])))
+    return errors
+
+
+def checkCompare(chip, tstFile, cmpFile):
+    columns = readCompare(tstFile, cmpFile, chip.widths())
+    inputs = {pin: columns[pin][0] for pin in chip.netlist.inputs}
+    outputs = chip.run(inputs)
+    expected = {pin: columns[pin][0] for pin in chip.netlist.outputs
+                if pin in columns}
+    known = {pin: columns[pin][1] for pin in expected}
+    return len(columns[chip.netlist.inputs[0]][0]), mismatches(
+        outputs, expected, known)
+
+
+def checkReference(chip, count=None, seed=0):
+    widths = chip.widths()
+    total = sum(widths[pin] for pin in chip.netlist.inputs)
+    if (count is None and total <= EXHAUSTIVE_BITS):
+        inputs = exhaustiveInputs(chip)
+    else:
+        inputs = randomInputs(chip, count or 1 << 16, seed)
+    expected = MODELS[chip.netlist.name](inputs)
+    outputs = chip.run(inputs)
+    return len(next(iter(inputs.values()))), mismatches(outputs, expected)
+
+
+def report(kind, name, vectors, errors):
+    status = "FAIL" if errors else "ok"
+    print("{:<4} {:<10} {:<9} {} vectors".format(status, name, kind, vectors))
+    for pin, i, got, want in errors:
+        print("     vector {}: {} = {}, expected {}".format(i, pin, got, want))
+
+
+if (__name__ == "__main__"):
+    args = argparse.ArgumentParser()
+    args.add_argument("filenames", nargs="+", help=".hdl files of the chips")
+    args.add_argument("--random", type=int, default=None, metavar="COUNT",
+                      help="check COUNT random vectors against the reference "
+                           "model instead of every input combination")
+    args.add_argument("--seed", type=int, default=0)
+    instrument.addArguments(args)
+    args = args.parse_args()
+    instrument.configure(trace, args)
+
+    failed = False
+    for filename in args.filenames:
+        path = Path(filename)
+        chip = ParallelChip(load(path).netlist)
+        tst = path.with_suffix(".tst")
+        cmp = path.with_suffix(".cmp")
+        if (tst.exists() and cmp.exists()):
+            vectors, errors = checkCompare(chip, tst, cmp)
+            report("compare", path.stem, vectors, errors)
+            failed = failed or bool(errors)
+        if (path.stem in MODELS):
+            vectors, errors = checkReference(chip, args.random, args.seed)
+            report("reference", path.stem, vectors, errors)
+            failed = failed or bool(errors)
+    instrument.finish(trace, args)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,154 @@
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import hdl
+from hdl import MODELS, trace
+import instrument
+from testscript import (INDEXED, ScriptError, TestScript, UnsupportedScript,
+                        findFile, findTests, parseValue, runTest)
+
+
+def defaultBuiltins(directory):
+    # Like the course's simulator: a part whose .hdl is not next to the
+    # test runs as a built-in model when there is one.
+    return [name for name in MODELS
+            if not (Path(directory) / (name + ".hdl")).exists()]
+
+
+def readHack(filename):
+    with open(filename, "r") as file:
+        return [int(l, 2) for l in file if l.strip() != ""]
+
+
+class HdlTest(TestScript):
+    def __init__(self, filename, writeOutput=True, gates=False,
+                 events=False, builtins=(), cache=True):
+        TestScript.__init__(self, filename, writeOutput)
+        self.gates = gates
+        self.events = events
+        self.builtins = list(builtins)
+        self.cache = cache
+        self.chip = None
+        self.time = 0
+        self.ticked = False
+
+    def clocked(self, words):
+        return words[0] in ["tick", "tock"]
+
+    def simulate(self, words):
+        name = words[0]
+        if (name == "load"):
+            if (len(words) < 2 or not words[1].endswith(".hdl")):
+                raise UnsupportedScript("not a hardware simulator script")
+            self.load(findFile(self.directory, words[1]))
+        elif (self.chip is None):
+            raise ScriptError("no chip loaded")
+        elif (name == "set"):
+            self.set(words[1], parseValue(words[2]))
+        elif (name == "eval"):
+            self.chip.eval()
+        elif (name == "tick"):
+            self.chip.tick()
+            self.ticked = True
+        elif (name == "tock"):
+            self.chip.tock()
+            self.time += 1
+            self.ticked = False
+        elif (len(words) == 3 and words[1] == "load"):
+            # e.g. "ROM32K load Max.hack"
+            model = self.chip.models.get(name)
+            if (model is None):
+                raise ScriptError("no built-in part named " + name)
+            model.load(readHack(findFile(self.directory, words[2])))
+            self.chip.refresh(model)
+        else:
+            raise ScriptError("unknown command: " + name)
+
+    def load(self, filename):
+        builtins = list(self.builtins)
+        if (not self.gates):
+            builtins += defaultBuiltins(self.directory)
+        self.chip = hdl.load(filename, events=self.events, builtins=builtins,
+                             cache=self.cache)
+
+    def value(self, name):
+        if (name == "time"):
+            return "{}{}".format(self.time, "+" if self.ticked else "")
+        indexed = INDEXED.match(name)
+        if (indexed is not None):
+            index = indexed.group(2)
+            return self.chip.part(indexed.group(1),
+                                  int(index) if index else None)
+        return self.chip.get(name)
+
+    def set(self, name, value):
+        indexed = INDEXED.match(name)
+        if (indexed is not None):
+            index = indexed.group(2)
+            self.chip.poke(indexed.group(1), int(index) if index else None,
+                           value)
+        else:
+            self.chip.set(name, value)
+
+
+def runHdlTest(filename, writeOutput=True, gates=False, events=False,
+               builtins=(), cache=True):
+    test = HdlTest(filename, writeOutput, gates, events, builtins, cache)
+    result = runTest(test)
+    result["nands"] = len(test.chip.netlist.nands) if test.chip else 0
+    result["ticks"] = test.time
+    return result
+
+
+if (__name__ == "__main__"):
+    args = argparse.ArgumentParser()
+    args.add_argument("paths", nargs="*",
+                      default=[str(hdl.PROJECTS / d)
+                               for d in ["01", "02", "03", "05"]],
+                      help=".tst files or directories to search for them")
+    args.add_argument("--jobs", type=int, default=None)
+    args.add_argument("--no-output-files", action="store_true",
+                      help="compare without writing .out files")
+    args.add_argument("--gates", action="store_true",
+                      help="simulate every part from its .hdl; a gate-level "
+                           "RAM16K is about a million Nands, too many to "
+                           "compile in memory")
+    args.add_argument("--events", action="store_true",
+                      help="use event-driven simulation")
+    args.add_argument("--builtin", action="append", default=list(),
+                      choices=sorted(MODELS), metavar="CHIP",
+                      help="also simulate this part behaviorally")
+    args.add_argument("--no-cache", action="store_true",
+                      help="flatten every chip instead of reusing the "
+                           ".hdlcache files")
+    instrument.addArguments(args)
+    args = args.parse_args()
+    instrument.configure(trace, args)
+
+    tests = findTests(args.paths)
+    failed = 0
+    results = list()
+    with trace.phase("run"):
+        with ProcessPoolExecutor(args.jobs) as pool:
+            for result in pool.map(runHdlTest, tests,
+                                   [not args.no_output_files] * len(tests),
+                                   [args.gates] * len(tests),
+                                   [args.events] * len(tests),
+                                   [args.builtin] * len(tests),
+                                   [not args.no_cache] * len(tests)):
+                trace.count(result["status"])
+                if (result["status"] in ["fail", "error"]):
+                    failed += 1
+                print("{:<5} {:>8.3f}s {:>8} nands {:>6} ticks  {}".format(
+                    result["status"], result["seconds"], result["nands"],
+                    result["ticks"], result["test"]))
+                if (result["message"] and result["status"] != "skip"):
+                    print("      " + result["message"])
+                results.append(result)
+    busy = sum(r["seconds"] for r in results)
+    trace.info("{} tests, {:.2f}s of simulation in {:.2f}s", len(results),
+               busy, trace.phases["run"])
+    instrument.finish(trace, args)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,90 @@
+import json
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40, "off": 100}
+
+
+class Tracer:
+    def __init__(self, name, level="info"):
+        self.name = name
+        self.counters = Counter()
+        self.phases = dict()
+        self.stream = None
+        self.setLevel(level)
+
+    def setLevel(self, level):
+        self.level = LEVELS[level]
+        # Hot loops test this flag before building a message at all.
+        self.debugging = self.level <= LEVELS["debug"]
+
+    def log(self, level, message, *args):
+        if (LEVELS[level] < self.level):
+            return
+        if (args):
+            message = message.format(*args)
+        stream = self.stream or sys.stderr
+        stream.write("[{}] {}\n".format(self.name, message))
+
+    def debug(self, message, *args):
+        if (self.debugging):
+            self.log("debug", message, *args)
+
+    def info(self, message, *args):
+        self.log("info", message, *args)
+
+    def warning(self, message, *args):
+        self.log("warning", message, *args)
+
+    def error(self, message, *args):
+        self.log("error", message, *args)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def profile(self):
+        return {
+            "tool": self.name,
+            "phases": dict(self.phases),
+            "counters": dict(self.counters),
+        }
+
+    def summary(self):
+        for name, seconds in self.phases.items():
+            self.info("{:<12} {:.4f}s", name, seconds)
+        for name, value in sorted(self.counters.items()):
+            self.info("{:<12} {}", name, value)
+
+    def dump(self, filename):
+        with open(filename, "w") as out:
+            json.dump(self.profile(), out, indent=2)
+            out.write("\n")
+
+
+def addArguments(parser):
+    parser.add_argument("--log-level", default="info",
+                        choices=sorted(LEVELS, key=LEVELS.get))
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write phase timings and counters as JSON")
+
+
+def configure(tracer, args):
+    tracer.setLevel(args.log_level)
+
+
+def finish(tracer, args):
+    if (tracer.debugging):
+        tracer.summary()
+    if (args.profile):
+        tracer.dump(args.profile)
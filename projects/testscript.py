@@ -0,0 +1,243 @@
+import os
+import re
+import time
+
+TOKEN = re.compile(r'"[^"]*"|[{},;!]|[^\s{},;!]+')
+COMMENT = re.compile(r"//[^\n]*|/\*.*?\*/", re.S)
+OUTPUT = re.compile(r"^([^%]+)(?:%([BDXS])(\d+)\.(\d+)\.(\d+))?$")
+INDEXED = re.compile(r"^(\w+)\[(\d*)\]$")
+CONDITIONS = {
+    "=": lambda x, y: x == y,
+    "<>": lambda x, y: x != y,
+    "<": lambda x, y: x < y,
+    ">": lambda x, y: x > y,
+    "<=": lambda x, y: x <= y,
+    ">=": lambda x, y: x >= y,
+}
+# A while loop that runs this long without a clock is waiting for input.
+WHILE_LIMIT = 100000
+
+
+class ScriptError(Exception):
+    pass
+
+
+class UnsupportedScript(ScriptError):
+    # Scripts for the other simulators, or interactive ones.
+    pass
+
+
+def parseScript(text):
+    # A script is a list of (words, body) commands, where body is the
+    # nested command list of a repeat/while block and None otherwise.
+    tokens = TOKEN.findall(COMMENT.sub(" ", text))
+    commands, _ = parseBlock(tokens, 0)
+    return commands
+
+
+def parseBlock(tokens, i):
+    commands = list()
+    words = list()
+    while (i < len(tokens)):
+        token = tokens[i]
+        i += 1
+        if (token == "{"):
+            body, i = parseBlock(tokens, i)
+            commands.append((words, body))
+            words = list()
+        elif (token == "}"):
+            break
+        elif (token in [",", ";", "!"]):
+            if (words):
+                commands.append((words, None))
+            words = list()
+        else:
+            words.append(token)
+    if (words):
+        commands.append((words, None))
+    return commands, i
+
+
+def findFile(directory, name):
+    # The course scripts do not always match the case of the files they
+    # load, e.g. Mult.tst loads Mult.hack next to mult.hack.
+    path = os.path.join(directory, name)
+    if (os.path.exists(path)):
+        return path
+    for child in os.listdir(directory):
+        if (child.lower() == name.lower()):
+            return os.path.join(directory, child)
+    raise ScriptError("cannot find " + name)
+
+
+def signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def parseValue(text):
+    # Script literals: decimal, or %B, %X and %D prefixed.
+    if (text.startswith("%B")):
+        return int(text[2:], 2)
+    if (text.startswith("%X")):
+        return int(text[2:], 16)
+    if (text.startswith("%D")):
+        return int(text[2:])
+    return int(text)
+
+
+class Column:
+    def __init__(self, text):
+        match = OUTPUT.match(text)
+        if (match is None):
+            raise ScriptError("bad output-list entry: " + text)
+        self.name = match.group(1)
+        self.format = match.group(2) or "D"
+        self.left = int(match.group(3) or 1)
+        self.width = int(match.group(4) or 6)
+        self.right = int(match.group(5) or 1)
+
+    def header(self):
+        width = self.left + self.width + self.right
+        name = self.name[:width]
+        left = (width - len(name)) // 2
+        return " " * left + name + " " * (width - left - len(name))
+
+    def cell(self, value):
+        if (self.format == "S"):
+            text = str(value).ljust(self.width)[:self.width]
+        elif (self.format == "B"):
+            text = "{0:016b}".format(value & 0xFFFF)[-self.width:]
+        elif (self.format == "X"):
+            text = "{0:04X}".format(value & 0xFFFF)[-self.width:]
+        else:
+            text = str(signed(value & 0xFFFF)).rjust(self.width)
+        return " " * self.left + text + " " * self.right
+
+
+def matches(line, expected):
+    # '*' in a compare file matches any character.
+    if (len(line) != len(expected)):
+        return False
+    for got, want in zip(line, expected):
+        if (want != "*" and got != want):
+            return False
+    return True
+
+
+class TestScript:
+    # The parts of the test script language shared by the simulators.
+    # Subclasses implement simulate() for their own commands, value() to
+    # read a variable and clocked() to tell clock commands apart.
+    def __init__(self, filename, writeOutput=True):
+        self.filename = filename
+        self.directory = os.path.dirname(os.path.abspath(filename))
+        self.writeOutput = writeOutput
+        self.columns = list()
+        self.lines = list()
+        self.outputFile = None
+        self.compareFile = None
+
+    def run(self):
+        with open(self.filename, "r") as file:
+            commands = parseScript(file.read())
+        self.execute(commands)
+        if (self.writeOutput and self.outputFile is not None):
+            with open(self.outputFile, "w") as out:
+                out.write("\n".join(self.lines) + "\n")
+        return self.compare()
+
+    def compare(self):
+        if (self.compareFile is None):
+            return None
+        with open(self.compareFile, "r") as file:
+            expected = [l.rstrip() for l in file.read().splitlines()]
+        expected = [l for l in expected if l != ""]
+        for number, line in enumerate(self.lines):
+            if (number >= len(expected)):
+                return "line {}: no line to compare with".format(number + 1)
+            if (not matches(line.rstrip(), expected[number])):
+                return "line {}: got {!r}, expected {!r}".format(
+                    number + 1, line, expected[number])
+        return None
+
+    def execute(self, commands):
+        for words, body in commands:
+            if (body is None):
+                self.command(words)
+            elif (words[0] == "repeat"):
+                count = int(words[1]) if len(words) > 1 else None
+                self.repeat(count, body)
+            elif (words[0] == "while"):
+                self.loop(words[1:], body)
+            else:
+                raise ScriptError("unknown block: " + " ".join(words))
+
+    def repeat(self, count, body):
+        if (count is None):
+            raise UnsupportedScript("interactive script")
+        for _ in range(count):
+            self.execute(body)
+
+    def loop(self, condition, body):
+        clocked = any(self.clocked(words) for words, _ in body)
+        count = 0
+        while (self.condition(condition)):
+            self.execute(body)
+            count += 1
+            if (not clocked and count >= WHILE_LIMIT):
+                raise UnsupportedScript("interactive script")
+
+    def command(self, words):
+        name = words[0]
+        if (name == "output-file"):
+            self.outputFile = os.path.join(self.directory, words[1])
+        elif (name == "compare-to"):
+            self.compareFile = findFile(self.directory, words[1])
+        elif (name == "output-list"):
+            self.columns = [Column(text) for text in words[1:]]
+            self.lines.append("|" + "|".join(
+                [c.header() for c in self.columns]) + "|")
+        elif (name == "output"):
+            self.lines.append("|" + "|".join(
+                [c.cell(self.value(c.name)) for c in self.columns]) + "|")
+        elif (name in ["echo", "clear-echo", "breakpoint",
+                       "clear-breakpoints"]):
+            pass
+        else:
+            self.simulate(words)
+
+    def condition(self, words):
+        left, op, right = words
+        return CONDITIONS[op](signed(self.value(left)), parseValue(right))
+
+
+def runTest(script):
+    # Runs a TestScript and returns a result row for the runners' reports.
+    start = time.perf_counter()
+    try:
+        failure = script.run()
+        status = "fail" if failure else "pass"
+    except UnsupportedScript as e:
+        failure = str(e)
+        status = "skip"
+    except (ScriptError, OSError, ValueError, IndexError, KeyError) as e:
+        failure = str(e)
+        status = "error"
+    return {
+        "test": script.filename,
+        "status": status,
+        "message": failure,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def findTests(paths):
+    tests = list()
+    for path in paths:
+        if (os.path.isdir(path)):
+            for root, _, files in sorted(os.walk(path)):
+                tests.extend(os.path.join(root, f) for f in sorted(files)
+                             if f.endswith(".tst"))
+        else:
+            tests.append(path)
+    return tests